@@ -0,0 +1,250 @@
+# coding:utf-8
+"""
+Geister 対局の解析（悪手探し）
+
+記録した対局（GeisterWorkshop.save_game_records() の形式。--record をつけて起動した GeisterWorkshop.py や、
+GeisterBenchmark.py の --save-games が書き出す）を1手ずつ再生し、手を打った側から見た各局面を、
+予算を多めにした探索（GeisterWorkshop.SEARCH_EVALUATORS）で評価して、次のような手を見つける。
+  ・blunder       : 打った手の評価値が、最善手の評価値より BLUNDER_DROP 以上低い
+  ・missed_win    : 青コマで脱出できた（move_to_win()で勝てた）のに脱出しなかった
+  ・missed_defence: 自陣の角にいる、赤と決まっていない敵コマを取れた（move_to_no_lose()で防げた）のに取らなかった
+局面の評価はプロセスプールで並列に行い、結果は局面のハッシュでキャッシュするので、
+同じ局面が何度出てきても評価は1回だけで済む（--cache を指定すると、キャッシュをファイルに残して次回も使う）。
+初期配置がわからない側（人間との対局の相手側）の手は解析しない。
+
+使い方
+    python GeisterAnalysis.py games.jsonl --budget 2000 --out report
+    python GeisterAnalysis.py games.jsonl --evaluator expectimax --budget 6 --out report
+
+© Morikatron Inc. 2019
+"""
+
+from typing import Dict, List, Tuple
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import random
+
+import GeisterWorkshop as gw
+
+BLUNDER_DROP = 0.4  # 最善手との評価値の差がこれ以上なら悪手とする（評価値は -1〜1）
+ANALYSIS_BUDGETS = {  # 1局面あたりの予算の初期値（評価の方法ごと、予算の種類ごと）
+    'montecarlo': {'iterations': 2000, 'time_limit': 1.0},
+    'expectimax': {'iterations': 6, 'time_limit': 1.0},
+}
+ANALYSIS_TIME_LIMIT = 60.0  # 予算をiterationsで指定したときの、1局面あたりの秒数の上限（探索の既定の打ち切り時間のかわりに使う）
+# 解析では思考ルーチンの捕獲の方針（capture_above_e_color）に縛られず、すべての手を評価する
+ANALYSIS_CAPTURE_ABOVE_E_COLOR = gw.COL_R - 1.0
+HOME_CORNERS = {(gw.BOARD_HEIGHT - 1) * gw.BOARD_WIDTH, gw.BOARD_HEIGHT * gw.BOARD_WIDTH - 1}  # 自陣の脱出口のマス
+
+
+class Position:
+    """解析する1局面（手を打った側の視点）とその手を保持するクラス"""
+
+    def __init__(self, game_ix: int, ply: int, side: int, view: gw.Game, piece_ix: int, direction: str):
+        self.game_ix = game_ix  # 何局目か
+        self.ply = ply  # 何手目か（0から）
+        self.side = side  # 手を打った側
+        self.view = view  # 手を打つ直前の、手を打った側から見たゲーム状態
+        self.piece_ix = piece_ix  # 打ったコマの番号
+        self.direction = direction  # 打った方角
+        self.state = gw.SimState.from_game(view)
+        self.key = ''  # 局面のハッシュ（評価の方法と予算を含む）
+        self.flags = tactical_flags(self.state, piece_ix, direction)
+
+
+def tactical_flags(state: gw.SimState, piece_ix: int, direction: str) -> List[str]:
+    """探索しなくてもわかる見落とし（missed_win, missed_defence）を調べて返す"""
+    moves = state.legal_moves()
+    played = [move for move in moves if move[0] == piece_ix and move[1] == direction][0]
+    flags = []
+    if played[2] == gw.SIM_ESCAPED:
+        return flags
+    if any(move[2] == gw.SIM_ESCAPED for move in moves):
+        flags.append('missed_win')
+    defences = [move for move in moves
+                if move[2] in HOME_CORNERS and state.board[move[2]] >= gw.MAX_PIECES
+                and state.colors[state.board[move[2]]] != gw.COL_R]
+    if len(defences) > 0 and played not in defences:
+        flags.append('missed_defence')
+    return flags
+
+
+def position_key(state: gw.SimState, evaluator: str, budget_kind: str, budget: float) -> str:
+    """キャッシュに使う局面のハッシュを返す（手番側にわかっていることと評価の設定だけで決まる）"""
+    text = repr((state.squares, state.colors, [round(e, 4) for e in state.e_colors], evaluator, budget_kind, budget))
+    return hashlib.sha1(text.encode('ascii')).hexdigest()
+
+
+def replay(record: gw.GameRecord, game_ix: int) -> List[Position]:
+    """対局を再生して、解析できる側の局面をすべて返す"""
+    analysable = [side for side in (0, 1) if gw.COL_U not in record.layouts[side]]
+    positions = []
+    saved_g = gw.g
+    try:
+        views = gw.make_views(record)
+        for ply, (side, piece_ix, direction) in enumerate(record.moves):
+            if side in analysable:
+                view = pickle.loads(pickle.dumps(views[side]))  # その時点の局面を複製しておく
+                view.capture_above_e_color = ANALYSIS_CAPTURE_ABOVE_E_COLOR
+                positions.append(Position(game_ix, ply, side, view, piece_ix, direction))
+            gw.apply_view_move(views, side, piece_ix, direction)
+    finally:
+        gw.g = saved_g
+    return positions
+
+
+def evaluate_task(task: Tuple[str, gw.Game, str, str, float]) -> Tuple[str, List[Tuple[int, str, float]]]:
+    """ワーカープロセスで1局面を評価する。(局面のハッシュ, [(コマ番号, 方角, 評価値), ...]) を返す"""
+    key, view, evaluator, budget_kind, budget = task
+    random.seed(key)  # 同じ局面なら何度評価しても同じ結果にする
+    gw.g = view
+    moves = gw.list_correct_moves()
+    budget_args = {budget_kind: budget}
+    if budget_kind == 'iterations':
+        budget_args['time_limit'] = ANALYSIS_TIME_LIMIT  # 1手ぶんの思考時間ではなく、解析用に長めの上限で打ち切る
+    values = gw.SEARCH_EVALUATORS[evaluator](moves, **budget_args)
+    return key, [(move.piece_ix, move.direction, value) for move, value in zip(moves, values)]
+
+
+def evaluate_positions(positions: List[Position],
+                       evaluator: str,
+                       budget_kind: str,
+                       budget: float,
+                       cache: Dict[str, list],
+                       n_workers: int = None) -> None:
+    """キャッシュにない局面だけをプロセスプールで評価して、cacheに加える"""
+    tasks = {}
+    for position in positions:
+        position.key = position_key(position.state, evaluator, budget_kind, budget)
+        if position.key not in cache and position.key not in tasks:
+            tasks[position.key] = (position.key, position.view, evaluator, budget_kind, budget)
+    if len(tasks) == 0:
+        return
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    with multiprocessing.Pool(n_workers) as pool:
+        for key, values in pool.imap_unordered(evaluate_task, list(tasks.values()), chunksize=4):
+            cache[key] = values
+
+
+def move_string(state: gw.SimState, piece_ix: int, direction: str) -> str:
+    """手を、手を打った側から見た (x,y,方角) の文字列にする"""
+    sq = state.squares[piece_ix]
+    return '(%d,%d,%s)' % (sq % gw.BOARD_WIDTH, sq // gw.BOARD_WIDTH, direction)
+
+
+def annotate(position: Position, values: List[Tuple[int, str, float]]) -> dict:
+    """評価結果から、その手の注釈を作って返す"""
+    played_value = [v for piece_ix, direction, v in values
+                    if piece_ix == position.piece_ix and direction == position.direction][0]
+    best_piece_ix, best_direction, best_value = max(values, key=lambda v: v[2])
+    drop = best_value - played_value
+    flags = list(position.flags)
+    if drop >= BLUNDER_DROP:
+        flags.append('blunder')
+    return {'ply': position.ply,
+            'side': position.side,
+            'move': move_string(position.state, position.piece_ix, position.direction),
+            'value': played_value,
+            'best': move_string(position.state, best_piece_ix, best_direction),
+            'best_value': best_value,
+            'drop': drop,
+            'flags': flags}
+
+
+def game_report(record: gw.GameRecord, annotations: List[dict]) -> str:
+    """1局分の注釈つきの棋譜を文字列にして返す"""
+    if record.winner == gw.NO_PLAYER:
+        result = 'draw'
+    else:
+        result = 'winner: side %d (%s)' % (record.winner, record.names[record.winner])
+    lines = ['side 0: %s, side 1: %s, first: side %d, %s'
+             % (record.names[0], record.names[1], record.first_player, result)]
+    for a in annotations:
+        mark = '' if len(a['flags']) == 0 else '  <-- ' + ', '.join(a['flags'])
+        lines.append('%3d  side %d  %-9s %+.2f   best %-9s %+.2f  drop %.2f%s'
+                     % (a['ply'], a['side'], a['move'], a['value'], a['best'], a['best_value'], a['drop'], mark))
+    return '\n'.join(lines) + '\n'
+
+
+def summarize(records: List[gw.GameRecord], annotations: List[List[dict]]) -> Dict[str, dict]:
+    """思考ルーチン（プレイヤー）ごとに、悪手や見落としの数をまとめて返す"""
+    summary = {}
+    for record, game_annotations in zip(records, annotations):
+        for a in game_annotations:
+            name = record.names[a['side']] or 'side %d' % a['side']
+            s = summary.setdefault(name, {'moves': 0, 'total_drop': 0.0, 'blunder': 0,
+                                          'missed_win': 0, 'missed_defence': 0})
+            s['moves'] += 1
+            s['total_drop'] += a['drop']
+            for flag in a['flags']:
+                s[flag] += 1
+    for s in summary.values():
+        s['mean_drop'] = s['total_drop'] / s['moves']
+        s['blunders_per_100_moves'] = 100.0 * s['blunder'] / s['moves']
+        del s['total_drop']
+    return summary
+
+
+def analyse(records: List[gw.GameRecord],
+            evaluator: str = 'montecarlo',
+            budget_kind: str = 'iterations',
+            budget: float = None,
+            cache: Dict[str, list] = None,
+            n_workers: int = None) -> Tuple[List[List[dict]], Dict[str, dict]]:
+    """対局をまとめて解析し、(局ごとの注釈のリスト, 思考ルーチンごとのまとめ) を返す"""
+    if budget is None:
+        budget = ANALYSIS_BUDGETS[evaluator][budget_kind]
+    if cache is None:
+        cache = {}
+    games = [replay(record, game_ix) for game_ix, record in enumerate(records)]
+    evaluate_positions([position for positions in games for position in positions],
+                       evaluator, budget_kind, budget, cache, n_workers)
+    annotations = [[annotate(position, cache[position.key]) for position in positions] for positions in games]
+    return annotations, summarize(records, annotations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='find blunders in recorded Geister games')
+    parser.add_argument('games', nargs='+', help='game record files (one JSON game per line)')
+    parser.add_argument('--evaluator', default='montecarlo', choices=sorted(gw.SEARCH_EVALUATORS))
+    parser.add_argument('--budget-kind', default='iterations', choices=('iterations', 'time_limit'))
+    parser.add_argument('--budget', type=float, default=None,
+                        help='default: ANALYSIS_BUDGETS of the evaluator and budget kind')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cache', default=None, help='JSON file to keep evaluated positions between runs')
+    parser.add_argument('--out', default=None, help='directory for the per-game reports and summary.json')
+    args = parser.parse_args()
+    budget = args.budget
+    if budget is not None and args.budget_kind == 'iterations':
+        budget = int(budget)
+    records = [record for path in args.games for record in gw.load_game_records(path)]
+    cache = {}
+    if args.cache is not None and os.path.exists(args.cache):
+        with open(args.cache, encoding='utf-8') as f:
+            cache = json.load(f)
+    annotations, summary = analyse(records, args.evaluator, args.budget_kind, budget, cache, args.workers)
+    if args.cache is not None:
+        with open(args.cache, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+    if args.out is not None:
+        os.makedirs(args.out, exist_ok=True)
+        for game_ix, (record, game_annotations) in enumerate(zip(records, annotations)):
+            with open(os.path.join(args.out, 'game-%04d.txt' % game_ix), 'w', encoding='utf-8') as f:
+                f.write(game_report(record, game_annotations))
+        with open(os.path.join(args.out, 'summary.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+    else:
+        for record, game_annotations in zip(records, annotations):
+            print(game_report(record, game_annotations))
+    for name, s in sorted(summary.items()):
+        print('%-32s moves %4d  mean drop %.3f  blunders %3d  missed wins %3d  missed defences %3d'
+              % (name, s['moves'], s['mean_drop'], s['blunder'], s['missed_win'], s['missed_defence']))
+
+
+if __name__ == '__main__':
+    main()
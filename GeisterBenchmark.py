@@ -0,0 +1,226 @@
+# coding:utf-8
+"""
+Geister 思考ルーチンの「強さ対CPU時間」ベンチマーク
+
+予算（反復回数または1手あたりの秒数）を指定できる思考ルーチン（GeisterWorkshop.BUDGETED_THINKERS）を、
+予算を段階的に変えながら基準の相手（think_random(), think_various_rules_1()と、予算を固定した探索）と対戦させ、
+予算ごとの勝率と、基準の相手のEloを固定して求めたレーティングを、1手あたりに使ったCPU時間とともにJSONに保存する。
+全勝・全敗（飽和）した予算のレーティングは求められないので、saturated をつけて比較（補間）には使わない。
+対局はプロセスプールで並列に実行する。予算が違っても同じseedの列を使うので、予算の間の比較がぶれにくい。
+
+使い方
+    python GeisterBenchmark.py run --thinker montecarlo --budget-kind iterations --budgets 10 30 100 300 --out v1.json
+    python GeisterBenchmark.py compare v1.json v2.json
+
+© Morikatron Inc. 2019
+"""
+
+from typing import List, Tuple
+import argparse
+import functools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+
+import GeisterWorkshop as gw
+
+REFERENCE_OPPONENTS = ('random', 'rules1', 'montecarlo100', 'expectimax2')  # 基準の相手（REFERENCE_THINKERSの名前）
+REFERENCE_THINKERS = {  # 基準の相手の思考ルーチン。探索する思考ルーチンが全勝で飽和しないよう、予算を固定した探索も入れる
+    'random': gw.think_random,
+    'rules1': gw.think_various_rules_1,
+    'montecarlo100': functools.partial(gw.think_monte_carlo, iterations=100),
+    'expectimax2': functools.partial(gw.think_expectimax, iterations=2),
+}
+# 基準の相手のレーティング（この値に固定して、ほかのレーティングを求める）。
+# 基準の相手どうしを対戦させた得点率（rules1対random 0.64、montecarlo100対rules1 0.72、expectimax2対montecarlo100 0.93）から決めた
+REFERENCE_ELO = {'random': 0.0, 'rules1': 100.0, 'montecarlo100': 260.0, 'expectimax2': 710.0}
+RATING_MARGIN = 800.0  # レーティングを探す範囲（基準の相手のレーティングの最小〜最大から、この分だけ外側まで）
+BUDGET_KINDS = ('iterations', 'time_limit')  # 予算の種類（BUDGETED_THINKERSの引数名）
+DEFAULT_BUDGETS = {  # --budgetsを省略したときの予算の段階（思考ルーチンごと、予算の種類ごと）
+    ('montecarlo', 'iterations'): [10, 30, 100, 300],
+    ('montecarlo', 'time_limit'): [0.01, 0.03, 0.1, 0.3],
+    ('expectimax', 'iterations'): [1, 2, 3, 4, 5, 6],  # iterationsは読む深さ
+    ('expectimax', 'time_limit'): [0.01, 0.03, 0.1, 0.3],
+}
+
+
+def play_task(task: Tuple[str, str, float, str, int]) -> Tuple[float, str, int, float, int, dict]:
+    """ワーカープロセスで1局対戦する。
+    (予算, 相手, 結果(1:勝ち 0:引き分け -1:負け), 思考に使ったCPU時間, 打った手の数, 対局の記録) を返す"""
+    thinker_name, budget_kind, budget, reference, seed = task
+    thinker = functools.partial(gw.BUDGETED_THINKERS[thinker_name], **{budget_kind: budget})
+    random.seed(seed)
+    record = gw.play_game([thinker, REFERENCE_THINKERS[reference]], first_player=seed % 2)
+    record.names = ['%s(%s=%s)' % (thinker_name, budget_kind, budget), reference]
+    if record.winner == gw.NO_PLAYER:
+        result = 0
+    else:
+        result = 1 if record.winner == 0 else -1
+    n_moves = sum(1 for side, piece_ix, direction in record.moves if side == 0)
+    return budget, reference, result, record.think_time[0], n_moves, record.to_dict()
+
+
+def elo_from_score(score: float, n_games: int) -> float:
+    """得点率からElo差を返す。全勝・全敗でも無限大にならないよう、半局分だけ内側に寄せる"""
+    score = min(max(score, 0.5 / n_games), 1.0 - 0.5 / n_games)
+    return 400.0 * math.log10(score / (1.0 - score))
+
+
+def expected_score(rating: float, opponent_rating: float) -> float:
+    """レーティングの差から期待得点率を返す"""
+    return 1.0 / (1.0 + 10.0 ** ((opponent_rating - rating) / 400.0))
+
+
+def fit_rating(games: List[Tuple[float, float, int]]) -> Tuple[float, bool]:
+    """[(相手のレーティング, 得点の合計, 局数), ...] から、最尤推定したレーティングを二分法で求める。
+    (レーティング, 飽和したか) を返す。全勝・全敗では最尤推定値が無限大になるので、探す範囲の端を返して飽和とする"""
+    lo = min(r for r, score, n in games) - RATING_MARGIN
+    hi = max(r for r, score, n in games) + RATING_MARGIN
+    total_score = sum(score for r, score, n in games)
+    total_games = sum(n for r, score, n in games)
+    if total_score <= 0.0:
+        return lo, True
+    if total_score >= total_games:
+        return hi, True
+    for _ in range(60):
+        mid = (lo + hi) / 2.0
+        if sum(n * expected_score(mid, r) for r, score, n in games) < total_score:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2.0, False
+
+
+def run(thinker_name: str,
+        budget_kind: str,
+        budgets: List[float],
+        n_games: int,
+        n_workers: int = None,
+        seed: int = 0,
+        games_path: str = None) -> dict:
+    """予算ごと、基準の相手ごとにn_games局ずつ対戦して、結果をまとめたdictを返す。
+    games_pathを指定すると、対局の記録をそのファイルに追記する。結果は予算の値でまとめるので、同じ予算を2回指定してはいけない"""
+    if len(set(budgets)) != len(budgets):
+        raise ValueError('budgets must not repeat: %s' % budgets)
+    tasks = [(thinker_name, budget_kind, budget, reference, seed + i)
+             for budget in budgets for reference in REFERENCE_OPPONENTS for i in range(n_games)]
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    with multiprocessing.Pool(n_workers) as pool:
+        results = list(pool.imap_unordered(play_task, tasks, chunksize=4))
+    if games_path is not None:
+        gw.save_game_records(games_path, [gw.GameRecord.from_dict(r[5]) for r in results])
+    points = []
+    for budget in budgets:
+        point = {'budget': budget, 'results': {}}
+        games = []
+        cpu_seconds = 0.0
+        n_moves = 0
+        for reference in REFERENCE_OPPONENTS:
+            outcomes = [r for r in results if r[0] == budget and r[1] == reference]
+            wins = sum(1 for r in outcomes if r[2] == 1)
+            draws = sum(1 for r in outcomes if r[2] == 0)
+            losses = sum(1 for r in outcomes if r[2] == -1)
+            score = (wins + 0.5 * draws) / len(outcomes)
+            point['results'][reference] = {'wins': wins, 'draws': draws, 'losses': losses, 'score': score,
+                                           'elo_difference': elo_from_score(score, len(outcomes)),
+                                           'saturated': score in (0.0, 1.0)}
+            games.append((REFERENCE_ELO[reference], wins + 0.5 * draws, len(outcomes)))
+            cpu_seconds = cpu_seconds + sum(r[3] for r in outcomes)
+            n_moves = n_moves + sum(r[4] for r in outcomes)
+        point['elo'], point['saturated'] = fit_rating(games)
+        point['cpu_seconds_per_move'] = cpu_seconds / max(n_moves, 1)
+        points.append(point)
+    return {'thinker': thinker_name,
+            'budget_kind': budget_kind,
+            'references': list(REFERENCE_OPPONENTS),
+            'reference_elo': {reference: REFERENCE_ELO[reference] for reference in REFERENCE_OPPONENTS},
+            'games_per_reference': n_games,
+            'seed': seed,
+            'machine': {'processor': platform.processor(), 'python': platform.python_version(),
+                        'workers': n_workers},
+            'points': points}
+
+
+def interpolate_elo(points: List[dict], cpu_seconds: float) -> float:
+    """CPU時間（対数）に対してEloを線形補間する。範囲外ならNone。飽和した点は使わない"""
+    points = sorted([p for p in points if not p.get('saturated', False)], key=lambda p: p['cpu_seconds_per_move'])
+    for a, b in zip(points, points[1:]):
+        if a['cpu_seconds_per_move'] <= cpu_seconds <= b['cpu_seconds_per_move']:
+            la = math.log(max(a['cpu_seconds_per_move'], 1e-9))
+            lb = math.log(max(b['cpu_seconds_per_move'], 1e-9))
+            if lb == la:
+                return b['elo']
+            t = (math.log(max(cpu_seconds, 1e-9)) - la) / (lb - la)
+            return a['elo'] + t * (b['elo'] - a['elo'])
+    return None
+
+
+def show_result(result: dict) -> None:
+    """1つの結果を表として表示する"""
+    print('%s (%s)' % (result['thinker'], result['budget_kind']))
+    print('%10s %14s %10s  %s' % ('budget', 'cpu sec/move', 'elo', '  '.join(result['references'])))
+    for point in result['points']:
+        scores = '  '.join('%.2f' % point['results'][reference]['score'] for reference in result['references'])
+        mark = '*' if point.get('saturated', False) else ' '
+        print('%10s %14.5f %9.1f%s  %s' % (point['budget'], point['cpu_seconds_per_move'], point['elo'], mark, scores))
+    if any(point.get('saturated', False) for point in result['points']):
+        print('* saturated (won or lost every game): the elo is only a bound and is not used by compare')
+
+
+def compare(result_a: dict, result_b: dict) -> None:
+    """2つの結果を、同じCPU時間あたりのEloで比べて表示する"""
+    show_result(result_a)
+    show_result(result_b)
+    print('elo of B minus elo of A at the same cpu sec/move')
+    for point in result_a['points']:
+        elo_b = interpolate_elo(result_b['points'], point['cpu_seconds_per_move'])
+        if elo_b is None or point.get('saturated', False):
+            print('%14.5f %8s' % (point['cpu_seconds_per_move'], '-'))
+        else:
+            print('%14.5f %+8.1f' % (point['cpu_seconds_per_move'], elo_b - point['elo']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Geister strength versus CPU time benchmark')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_run = subparsers.add_parser('run', help='play the budget ladder and save the result as JSON')
+    parser_run.add_argument('--thinker', default='montecarlo', choices=sorted(gw.BUDGETED_THINKERS))
+    parser_run.add_argument('--budget-kind', default='iterations', choices=BUDGET_KINDS)
+    parser_run.add_argument('--budgets', type=float, nargs='+', default=None,
+                            help='default: DEFAULT_BUDGETS of the thinker and budget kind')
+    parser_run.add_argument('--games', type=int, default=50, help='games per budget and reference opponent')
+    parser_run.add_argument('--workers', type=int, default=None)
+    parser_run.add_argument('--seed', type=int, default=0)
+    parser_run.add_argument('--out', default='benchmark.json')
+    parser_run.add_argument('--save-games', default=None, help='append the game records to this file')
+    parser_compare = subparsers.add_parser('compare', help='compare two saved results')
+    parser_compare.add_argument('result_a')
+    parser_compare.add_argument('result_b')
+    args = parser.parse_args()
+    if args.command == 'run':
+        budgets = args.budgets
+        if budgets is None:
+            budgets = DEFAULT_BUDGETS[(args.thinker, args.budget_kind)]
+        budgets = [int(b) if args.budget_kind == 'iterations' else b for b in budgets]
+        if len(set(budgets)) != len(budgets):
+            parser.error('--budgets must not repeat a value')
+        result = run(args.thinker, args.budget_kind, budgets, args.games, args.workers, args.seed, args.save_games)
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+        show_result(result)
+    elif args.command == 'compare':
+        with open(args.result_a, encoding='utf-8') as f:
+            result_a = json.load(f)
+        with open(args.result_b, encoding='utf-8') as f:
+            result_b = json.load(f)
+        compare(result_a, result_b)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+# coding:utf-8
+"""
+Geister 初期配置とブラフの方針を CFR（Counterfactual Regret Minimization）で求める
+
+ガイスターの全局面でCFRを回すのは無理なので、次の3つの判断だけからなる「抽象化したガイスター」を解く。
+  1. 初期配置    : PLACEMENTS のどれを使うか
+  2. 序盤の攻め方: 最初の LEAD_MOVES 手を赤コマで攻めるか、青コマで攻めるか（赤で攻めるのがブラフ）
+  3. 捕獲の方針  : 敵の赤を何個取ったら、色が不明なコマを取らなくするか（CAPTURE_LIMITS）
+作戦（1〜3の組み合わせ）どうしの勝敗の期待値は、think_various_rules_1()に
+その作戦を引数として渡して自己対戦した結果の平均（モンテカルロ推定）を使う。自己対戦はプロセスプールで並列に行う。
+先手後手を半々にして対戦させるので、この抽象ゲームは対称なゼロサムゲームになる。
+そこでCFR+で1つの戦略を自分自身と対戦させて更新し、その平均戦略を対称な均衡の近似として使う。
+対局中にわかる情報（捕獲したコマの色など）は抽象化で捨てているので、判断は対局の最初にすべて決まる。
+
+後悔（regret）の表と推定した勝敗の表は、小さなバイナリファイル（チェックポイント）に保存するので、
+途中で止めても続きから計算できる。
+
+使い方
+    python GeisterCFR.py solve cfr.bin --games 20 --iterations 2000
+    python GeisterCFR.py show cfr.bin
+
+対戦で使う場合は python GeisterWorkshop.py --cfr cfr.bin で起動する。
+ほかのプログラムの思考ルーチンから使う場合は、load_strategy('cfr.bin') してから think_cfr() を、
+初期配置は sample_layout() を使う。
+
+© Morikatron Inc. 2019
+"""
+
+from array import array
+from typing import List, Tuple
+import argparse
+import functools
+import multiprocessing
+import os
+import random
+import struct
+
+import GeisterWorkshop as gw
+
+R = gw.COL_R
+B = gw.COL_B
+PLACEMENTS = [  # 初期配置の候補（コマ番号順の色。前の列4個、後ろの列4個の順）
+    ('front_red', [R, R, R, R, B, B, B, B]),
+    ('back_red', [B, B, B, B, R, R, R, R]),
+    ('left_red', [R, R, B, B, R, R, B, B]),
+    ('right_red', [B, B, R, R, B, B, R, R]),
+    ('center_red', [B, R, R, B, B, R, R, B]),
+    ('checker', [R, B, R, B, B, R, B, R]),
+]
+LEADS = [gw.COL_R, gw.COL_B]  # 序盤に攻めるコマの色
+CAPTURE_LIMITS = [2, 3]  # 敵の赤をこの数だけ取ったら、色が不明なコマを取らなくする
+LEAD_MOVES = 20  # 序盤とみなす手数
+
+N_PLACEMENTS = len(PLACEMENTS)
+N_LEADS = len(LEADS)
+N_CAPTURES = len(CAPTURE_LIMITS)
+N_STRATEGIES = N_PLACEMENTS * N_LEADS * N_CAPTURES  # 作戦（純粋戦略）の数
+# 情報集合ごとの表の位置。配置の情報集合が1つ、攻め方の情報集合が配置ごとに1つ、捕獲の情報集合が配置と攻め方ごとに1つ
+LEAD_OFFSET = N_PLACEMENTS
+CAPTURE_OFFSET = LEAD_OFFSET + N_PLACEMENTS * N_LEADS
+TABLE_SIZE = CAPTURE_OFFSET + N_PLACEMENTS * N_LEADS * N_CAPTURES
+
+CHECKPOINT_MAGIC = b'GCFR'
+CHECKPOINT_VERSION = 1
+CHECKPOINT_HEADER = '<4sIII'  # magic, version, 作戦の数, CFRの反復回数
+CHECKPOINT_EVERY = 500  # この反復回数ごとにチェックポイントを書く
+REPORT_EVERY = 100  # この反復回数ごとにexploitabilityを表示する
+
+
+def strategy_index(placement: int, lead: int, capture: int) -> int:
+    """(配置, 攻め方, 捕獲の方針) の番号から作戦の番号を返す"""
+    return (placement * N_LEADS + lead) * N_CAPTURES + capture
+
+
+def lead_index(placement: int) -> int:
+    """配置placementのときの、攻め方の情報集合の表の位置を返す"""
+    return LEAD_OFFSET + placement * N_LEADS
+
+
+def capture_index(placement: int, lead: int) -> int:
+    """配置placement、攻め方leadのときの、捕獲の方針の情報集合の表の位置を返す"""
+    return CAPTURE_OFFSET + (placement * N_LEADS + lead) * N_CAPTURES
+
+
+def split_strategy(s: int) -> Tuple[int, int, int]:
+    """作戦の番号を (配置, 攻め方, 捕獲の方針) の番号に分ける"""
+    return s // (N_LEADS * N_CAPTURES), (s // N_CAPTURES) % N_LEADS, s % N_CAPTURES
+
+
+def play_pair(task: Tuple[int, int, int]) -> Tuple[int, int, int]:
+    """ワーカープロセスで、作戦iと作戦jを1局対戦させる。(i, j, 作戦iから見た結果) を返す"""
+    i, j, seed = task
+    random.seed(seed)
+    layouts = []
+    thinkers = []
+    for s in (i, j):
+        placement, lead, capture = split_strategy(s)
+        layouts.append(list(PLACEMENTS[placement][1]))
+        thinkers.append(functools.partial(gw.think_various_rules_1, LEADS[lead], CAPTURE_LIMITS[capture], LEAD_MOVES))
+    record = gw.play_game(thinkers, layouts=layouts, first_player=seed % 2)
+    if record.winner == gw.NO_PLAYER:
+        return i, j, 0
+    return i, j, 1 if record.winner == 0 else -1
+
+
+class CFRSolver:
+    """抽象化したガイスターの勝敗の表と、CFR+の後悔・平均戦略の表を保持するクラス"""
+
+    def __init__(self):
+        self.regrets = array('d', [0.0] * TABLE_SIZE)  # 各情報集合の各行動の累積後悔
+        self.strategy_sums = array('d', [0.0] * TABLE_SIZE)  # 平均戦略を求めるための累積
+        self.payoff_sums = array('d', [0.0] * (N_STRATEGIES * N_STRATEGIES))  # 作戦i対作戦jの結果の合計（iから見た値）
+        self.payoff_counts = array('i', [0] * (N_STRATEGIES * N_STRATEGIES))  # 作戦i対作戦jの対局数
+        self.iterations = 0  # CFRの反復回数
+
+    def save(self, path: str) -> None:
+        """チェックポイントを書く"""
+        header = struct.pack(CHECKPOINT_HEADER, CHECKPOINT_MAGIC, CHECKPOINT_VERSION, N_STRATEGIES, self.iterations)
+        gw.replace_file(path, header + self.regrets.tobytes() + self.strategy_sums.tobytes()
+                        + self.payoff_sums.tobytes() + self.payoff_counts.tobytes())
+
+    @classmethod
+    def load(cls, path: str):
+        """チェックポイントを読む"""
+        solver = cls()
+        with open(path, 'rb') as f:
+            magic, version, n_strategies, iterations = struct.unpack(
+                CHECKPOINT_HEADER, f.read(struct.calcsize(CHECKPOINT_HEADER)))
+            if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION or n_strategies != N_STRATEGIES:
+                raise ValueError(path + ' is not a checkpoint of this abstraction')
+            solver.iterations = iterations
+            for table in (solver.regrets, solver.strategy_sums, solver.payoff_sums, solver.payoff_counts):
+                n = len(table)
+                del table[:]
+                table.fromfile(f, n)
+        return solver
+
+    def estimate_payoffs(self, games_per_pair: int, n_workers: int = None, seed: int = 0) -> None:
+        """作戦の組み合わせごとに、対局数がgames_per_pairになるまで自己対戦して勝敗の表を更新する。
+        i対jとj対iは同じ対局を裏から見たものなので、i < j の組だけ対戦させる（i対iは0とする）"""
+        tasks = []
+        for i in range(N_STRATEGIES):
+            for j in range(i + 1, N_STRATEGIES):
+                done = self.payoff_counts[i * N_STRATEGIES + j]
+                for n in range(done, games_per_pair):
+                    tasks.append((i, j, seed + (i * N_STRATEGIES + j) * games_per_pair + n))
+        if len(tasks) == 0:
+            return
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        with multiprocessing.Pool(n_workers) as pool:
+            for i, j, result in pool.imap_unordered(play_pair, tasks, chunksize=16):
+                self.payoff_sums[i * N_STRATEGIES + j] += result
+                self.payoff_counts[i * N_STRATEGIES + j] += 1
+                self.payoff_sums[j * N_STRATEGIES + i] -= result
+                self.payoff_counts[j * N_STRATEGIES + i] += 1
+
+    def payoff(self, i: int, j: int) -> float:
+        """作戦i対作戦jの勝敗の期待値（iから見た値）の推定値を返す"""
+        n = self.payoff_counts[i * N_STRATEGIES + j]
+        return self.payoff_sums[i * N_STRATEGIES + j] / n if n > 0 else 0.0
+
+    def current_strategy(self, offset: int, n_actions: int) -> List[float]:
+        """情報集合の、後悔に比例した現在の戦略を返す（regret matching）"""
+        positives = [max(r, 0.0) for r in self.regrets[offset:offset + n_actions]]
+        total = sum(positives)
+        if total <= 0.0:
+            return [1.0 / n_actions] * n_actions
+        return [p / total for p in positives]
+
+    def average_strategy(self, offset: int, n_actions: int) -> List[float]:
+        """情報集合の平均戦略を返す"""
+        sums = self.strategy_sums[offset:offset + n_actions]
+        total = sum(sums)
+        if total <= 0.0:
+            return [1.0 / n_actions] * n_actions
+        return [x / total for x in sums]
+
+    def strategy_distribution(self, behaviour) -> List[float]:
+        """情報集合ごとの戦略（behaviour(offset, n_actions)で得る）から、作戦ごとの確率を返す"""
+        distribution = [0.0] * N_STRATEGIES
+        placement_probs = behaviour(0, N_PLACEMENTS)
+        for p in range(N_PLACEMENTS):
+            lead_probs = behaviour(lead_index(p), N_LEADS)
+            for l in range(N_LEADS):
+                capture_probs = behaviour(capture_index(p, l), N_CAPTURES)
+                for c in range(N_CAPTURES):
+                    distribution[strategy_index(p, l, c)] = placement_probs[p] * lead_probs[l] * capture_probs[c]
+        return distribution
+
+    def strategy_values(self, distribution: List[float]) -> List[float]:
+        """相手が作戦をdistributionで選ぶときの、各作戦の勝敗の期待値を返す"""
+        return [sum(q * self.payoff(s, t) for t, q in enumerate(distribution)) for s in range(N_STRATEGIES)]
+
+    def iterate(self) -> None:
+        """CFR+を1反復する。相手も同じ現在の戦略を使うとして、各情報集合の後悔と平均戦略を更新する"""
+        self.iterations = self.iterations + 1
+        values = self.strategy_values(self.strategy_distribution(self.current_strategy))
+        weight = float(self.iterations)  # CFR+ では平均戦略を反復回数で重みづけする
+        placement_probs = self.current_strategy(0, N_PLACEMENTS)
+        placement_values = []
+        for p in range(N_PLACEMENTS):
+            lead_probs = self.current_strategy(lead_index(p), N_LEADS)
+            lead_values = []
+            for l in range(N_LEADS):
+                offset = capture_index(p, l)
+                capture_probs = self.current_strategy(offset, N_CAPTURES)
+                capture_values = [values[strategy_index(p, l, c)] for c in range(N_CAPTURES)]
+                node_value = sum(pr * v for pr, v in zip(capture_probs, capture_values))
+                reach = placement_probs[p] * lead_probs[l]
+                for c in range(N_CAPTURES):
+                    self.regrets[offset + c] = max(self.regrets[offset + c] + capture_values[c] - node_value, 0.0)
+                    self.strategy_sums[offset + c] += weight * reach * capture_probs[c]
+                lead_values.append(node_value)
+            offset = lead_index(p)
+            node_value = sum(pr * v for pr, v in zip(lead_probs, lead_values))
+            for l in range(N_LEADS):
+                self.regrets[offset + l] = max(self.regrets[offset + l] + lead_values[l] - node_value, 0.0)
+                self.strategy_sums[offset + l] += weight * placement_probs[p] * lead_probs[l]
+            placement_values.append(node_value)
+        node_value = sum(pr * v for pr, v in zip(placement_probs, placement_values))
+        for p in range(N_PLACEMENTS):
+            self.regrets[p] = max(self.regrets[p] + placement_values[p] - node_value, 0.0)
+            self.strategy_sums[p] += weight * placement_probs[p]
+
+    def exploitability(self) -> float:
+        """平均戦略の exploitability（最善の作戦で対抗されたときに失う期待値。ゲームの値は0）を返す"""
+        return max(self.strategy_values(self.strategy_distribution(self.average_strategy)))
+
+    def solve(self, iterations: int, path: str = None) -> None:
+        """CFRをiterations回反復する。途中でexploitabilityを表示し、pathがあればチェックポイントを書く"""
+        for _ in range(iterations):
+            self.iterate()
+            if self.iterations % REPORT_EVERY == 0:
+                print('iteration %d exploitability %.4f' % (self.iterations, self.exploitability()))
+            if path is not None and self.iterations % CHECKPOINT_EVERY == 0:
+                self.save(path)
+        if path is not None:
+            self.save(path)
+
+
+class CFRStrategy:
+    """CFRの平均戦略から、初期配置と作戦をサンプリングするクラス"""
+
+    def __init__(self, solver: CFRSolver):
+        self.placement_probs = solver.average_strategy(0, N_PLACEMENTS)
+        self.lead_probs = [solver.average_strategy(lead_index(p), N_LEADS) for p in range(N_PLACEMENTS)]
+        self.capture_probs = [[solver.average_strategy(capture_index(p, l), N_CAPTURES) for l in range(N_LEADS)]
+                              for p in range(N_PLACEMENTS)]
+        self.distribution = solver.strategy_distribution(solver.average_strategy)
+
+    def sample_layout(self) -> List[float]:
+        """初期配置（コマ番号順の色のリスト）をサンプリングして返す"""
+        p = weighted_choice(self.placement_probs)
+        return list(PLACEMENTS[p][1])
+
+    def sample_plan(self, layout: List[float]) -> Tuple[float, int]:
+        """初期配置layoutのときの (序盤に攻めるコマの色, 捕獲をやめる赤の数) をサンプリングして返す。
+        layoutがPLACEMENTSにない配置なら、配置を問わない作戦の確率でサンプリングする"""
+        placements = [p for p, (name, colors) in enumerate(PLACEMENTS) if colors == list(layout)]
+        if len(placements) > 0:
+            p = placements[0]
+            lead = weighted_choice(self.lead_probs[p])
+            capture = weighted_choice(self.capture_probs[p][lead])
+        else:
+            placement, lead, capture = split_strategy(weighted_choice(self.distribution))
+        return LEADS[lead], CAPTURE_LIMITS[capture]
+
+
+def weighted_choice(probs: List[float]) -> int:
+    """確率probsに従って番号を選ぶ"""
+    r = random.random() * sum(probs)
+    for i, prob in enumerate(probs):
+        r = r - prob
+        if r < 0.0:
+            return i
+    return len(probs) - 1
+
+
+strategy = None  # load_strategy()で読み込んだCFRStrategy
+
+
+def load_strategy(path: str) -> CFRStrategy:
+    """チェックポイントから平均戦略を読み込み、think_cfr()とsample_layout()で使えるようにする"""
+    global strategy
+    strategy = CFRStrategy(CFRSolver.load(path))
+    return strategy
+
+
+def sample_layout() -> List[float]:
+    """読み込んだ平均戦略に従って初期配置をサンプリングして返す"""
+    return strategy.sample_layout()
+
+
+def think_cfr() -> gw.Move:
+    """読み込んだ平均戦略に従って打つ。作戦は対局の最初に、自分の初期配置に応じてサンプリングして決める"""
+    if gw.g.plan is None:
+        gw.g.plan = strategy.sample_plan([piece.color for piece in gw.g.players[gw.ME].pieces])
+    lead_color, capture_limit = gw.g.plan
+    return gw.think_various_rules_1(lead_color, capture_limit, LEAD_MOVES)
+
+
+def show(solver: CFRSolver) -> None:
+    """平均戦略を表示する"""
+    average = CFRStrategy(solver)
+    n_games = min(solver.payoff_counts[i * N_STRATEGIES + j]
+                  for i in range(N_STRATEGIES) for j in range(N_STRATEGIES) if i != j)
+    print('iterations %d, games per pair %d, exploitability %.4f'
+          % (solver.iterations, n_games, solver.exploitability()))
+    for p, (name, colors) in enumerate(PLACEMENTS):
+        leads = ' '.join('%s:%.2f' % ('red' if LEADS[l] == gw.COL_R else 'blue', average.lead_probs[p][l])
+                         for l in range(N_LEADS))
+        print('%-12s %.3f  lead %s' % (name, average.placement_probs[p], leads))
+        for l in range(N_LEADS):
+            captures = ' '.join('stop after %d reds:%.2f' % (CAPTURE_LIMITS[c], average.capture_probs[p][l][c])
+                                for c in range(N_CAPTURES))
+            print('%-12s        %-5s %s' % ('', 'red' if LEADS[l] == gw.COL_R else 'blue', captures))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CFR solver for an abstracted Geister')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_solve = subparsers.add_parser('solve', help='estimate payoffs by self-play and run CFR+')
+    parser_solve.add_argument('checkpoint')
+    parser_solve.add_argument('--games', type=int, default=20, help='self-play games per pair of strategies')
+    parser_solve.add_argument('--iterations', type=int, default=2000)
+    parser_solve.add_argument('--workers', type=int, default=None)
+    parser_solve.add_argument('--seed', type=int, default=0)
+    parser_show = subparsers.add_parser('show', help='show the average strategy in a checkpoint')
+    parser_show.add_argument('checkpoint')
+    args = parser.parse_args()
+    if args.command == 'solve':
+        if os.path.exists(args.checkpoint):
+            solver = CFRSolver.load(args.checkpoint)
+        else:
+            solver = CFRSolver()
+        solver.estimate_payoffs(args.games, args.workers, args.seed)
+        solver.save(args.checkpoint)
+        solver.solve(args.iterations, args.checkpoint)
+        show(solver)
+    elif args.command == 'show':
+        show(CFRSolver.load(args.checkpoint))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
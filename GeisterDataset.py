@@ -0,0 +1,290 @@
+# coding:utf-8
+"""
+Geister 自己対戦による学習データ生成
+
+自己対戦の各局面（両者の本当のコマ色つき）、その局面で選んだ手、最終的な勝敗を
+固定サイズのシャードファイル（.npy形式）に書き出し、シャッフルしながら読み出す。
+
+・シャードは numpy.load(path, mmap_mode='r') でそのまま読める .npy 形式（dtype '<i2'、shape (行数, RECORD_FIELDS)）。
+　ただしこのプログラム自体は標準ライブラリの mmap と struct で読み書きするので、numpyは不要。
+・複数のワーカープロセスが、それぞれ自分のシャードに並列に書き込む。
+・data_dir/manifest.json にシャードの一覧と各局の識別ハッシュを記録し、追記と重複除去に使う。
+
+使い方
+    python GeisterDataset.py generate data --games 10000 --workers 8
+    python GeisterDataset.py stats data
+
+© Morikatron Inc. 2019
+"""
+
+from typing import Iterator, List, Tuple
+import argparse
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import struct
+
+import GeisterWorkshop as gw
+
+# 1行（1局面）のレイアウト。すべて int16 で、座標とコマ色は手番側から見たもの。
+#   [0:24]  手番側のコマ8個の x, y, color
+#   [24:48] 相手のコマ8個の x, y, color（本当の色）
+#   [48] 手数  [49] 動かしたコマの番号  [50] 方角（Move.newsのインデックス）  [51] 手番側から見た勝敗（1, 0, -1）
+RECORD_FIELDS = 52
+FIELD_PLY = 48
+FIELD_PIECE_IX = 49
+FIELD_DIRECTION = 50
+FIELD_OUTCOME = 51
+RECORD_FORMAT = '<%dh' % RECORD_FIELDS
+RECORD_BYTES = struct.calcsize(RECORD_FORMAT)
+NPY_HEADER_BYTES = 128  # .npyのヘッダ領域の大きさ（行数が変わっても同じ大きさになるよう空白で埋める）
+SHARD_RECORDS = 65536  # 1シャードの行数
+MANIFEST_FILE = 'manifest.json'
+SHUFFLE_BUFFER = 16384  # 読み出し時のシャッフルバッファの大きさ
+OPEN_SHARDS = 4  # 読み出し時に同時に開いておくシャードの数
+
+
+def npy_header(n_records: int) -> bytes:
+    """n_records行分の .npy (version 1.0) ヘッダを返す"""
+    header = "{'descr': '<i2', 'fortran_order': False, 'shape': (%d, %d), }" % (n_records, RECORD_FIELDS)
+    header = header.ljust(NPY_HEADER_BYTES - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def position_row(views: List[gw.Game], side: int, move: gw.Move) -> List[int]:
+    """sideが手を打つ直前の局面と、その手を1行分の値にして返す（勝敗は0のまま）"""
+    row = []
+    mover = views[side]
+    true_op_pieces = views[1 - side].players[gw.ME].pieces  # 相手側の視点なら相手のコマの本当の色がわかる
+    for piece in mover.players[gw.ME].pieces:
+        row.extend((piece.x, piece.y, int(piece.color)))
+    for piece, true_piece in zip(mover.players[gw.OP].pieces, true_op_pieces):
+        row.extend((piece.x, piece.y, int(true_piece.color)))
+    row.extend((mover.n_moved, move.piece_ix, gw.Move.news.index(move.direction), 0))
+    return row
+
+
+def split_row(row: Tuple[int, ...]) -> Tuple[List[Tuple[int, int, int]], List[Tuple[int, int, int]], int, int, str, int]:
+    """1行を (手番側のコマ, 相手のコマ, 手数, コマ番号, 方角, 勝敗) に分解する"""
+    my_pieces = [tuple(row[i:i + 3]) for i in range(0, 24, 3)]
+    op_pieces = [tuple(row[i:i + 3]) for i in range(24, 48, 3)]
+    return (my_pieces, op_pieces, row[FIELD_PLY], row[FIELD_PIECE_IX],
+            gw.Move.news[row[FIELD_DIRECTION]], row[FIELD_OUTCOME])
+
+
+def game_key(record: gw.GameRecord) -> str:
+    """重複除去に使う、1局を識別するハッシュを返す"""
+    text = repr((record.layouts, record.first_player, record.moves))
+    return hashlib.sha1(text.encode('ascii')).hexdigest()[:16]
+
+
+class ShardWriter:
+    """1つのワーカーが書き込むシャードを管理するクラス。
+    シャードはSHARD_RECORDS行分の大きさで確保してmmapで書き込み、閉じるときに実際の行数に切り詰める"""
+
+    def __init__(self, data_dir: str, prefix: str):
+        self.data_dir = data_dir
+        self.prefix = prefix  # シャードのファイル名の先頭部分（ワーカーごとに別の名前にする）
+        self.shards = []  # 書き終えたシャードの情報（manifestに記録する形）
+        self.file = None
+        self.mm = None
+        self.n_records = 0  # 書き込み中のシャードの行数
+        self.games = []  # 書き込み中のシャードに最後の行が入った局のハッシュ
+
+    def open_shard(self) -> None:
+        """新しいシャードを確保して開く"""
+        name = '%s-%04d.npy' % (self.prefix, len(self.shards))
+        self.file = open(os.path.join(self.data_dir, name), 'w+b')
+        self.file.write(npy_header(SHARD_RECORDS))
+        self.file.truncate(NPY_HEADER_BYTES + SHARD_RECORDS * RECORD_BYTES)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.n_records = 0
+        self.games = []
+        self.shards.append({'file': name, 'records': 0, 'games': self.games})
+
+    def close_shard(self) -> None:
+        """書き込み中のシャードを実際の行数に切り詰めて閉じる"""
+        self.mm[0:NPY_HEADER_BYTES] = npy_header(self.n_records)
+        self.mm.flush()
+        self.mm.close()
+        self.file.truncate(NPY_HEADER_BYTES + self.n_records * RECORD_BYTES)
+        self.file.close()
+        self.shards[-1]['records'] = self.n_records
+        self.mm = None
+        self.file = None
+
+    def append(self, row: List[int]) -> None:
+        """1行書き込む。シャードがいっぱいなら次のシャードへ"""
+        if self.mm is None or self.n_records >= SHARD_RECORDS:
+            if self.mm is not None:
+                self.close_shard()
+            self.open_shard()
+        struct.pack_into(RECORD_FORMAT, self.mm, NPY_HEADER_BYTES + self.n_records * RECORD_BYTES, *row)
+        self.n_records = self.n_records + 1
+
+    def add_game(self, key: str) -> None:
+        """書き込み終えた局のハッシュを記録する"""
+        self.games.append(key)
+
+    def close(self) -> List[dict]:
+        """すべて閉じて、書いたシャードの情報を返す"""
+        if self.mm is not None:
+            self.close_shard()
+        return self.shards
+
+
+def generate_worker(args: Tuple[str, str, List[int], Tuple[str, str], List[str]]) -> Tuple[List[dict], int]:
+    """ワーカープロセスで実行する。seedごとに1局自己対戦して、自分のシャードに書き込む。
+    (書いたシャードの情報, 重複として書かなかった局の数) を返す"""
+    data_dir, prefix, seeds, thinker_names, known_games = args
+    thinkers = [gw.THINKERS[name] for name in thinker_names]
+    seen = set(known_games)
+    writer = ShardWriter(data_dir, prefix)
+    n_duplicates = 0
+    for seed in seeds:
+        random.seed(seed)
+        rows = []
+        record = gw.play_game(thinkers, first_player=seed % 2,
+                              callback=lambda views, side, move: rows.append((side, position_row(views, side, move))))
+        key = game_key(record)
+        if key in seen:  # 以前に書いた局と同じ局は書かない
+            n_duplicates = n_duplicates + 1
+            continue
+        if len(rows) == 0:  # 1手もない局は書かない
+            continue
+        seen.add(key)
+        for side, row in rows:
+            if record.winner != gw.NO_PLAYER:
+                row[FIELD_OUTCOME] = 1 if record.winner == side else -1
+            writer.append(row)
+        writer.add_game(key)
+    return writer.close(), n_duplicates
+
+
+def load_manifest(data_dir: str) -> dict:
+    """マニフェストを読み込む。なければ空のマニフェストを返す"""
+    path = os.path.join(data_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {'record_fields': RECORD_FIELDS, 'runs': 0, 'next_seed': 0, 'shards': []}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(data_dir: str, manifest: dict) -> None:
+    """マニフェストを書き込む"""
+    gw.replace_file(os.path.join(data_dir, MANIFEST_FILE), json.dumps(manifest).encode('utf-8'))
+
+
+def generate(data_dir: str,
+             n_games: int,
+             n_workers: int = None,
+             thinker_names: Tuple[str, str] = ('rules1', 'rules1'),
+             seed: int = None) -> Tuple[dict, int]:
+    """n_games局を自己対戦してdata_dirに追記し、(更新したマニフェスト, 重複として書かなかった局の数) を返す。
+    seedを省略すると、前回までに使ったseedの続き（マニフェストのnext_seed）から始めるので、
+    同じコマンドを繰り返すたびに新しい局が追記される。seedを指定すれば同じ局を作り直せるが、
+    すでにマニフェストにある局は書かない。
+    （同じ実行の中で、別々のワーカーが偶然同じ局を生成した場合の重複は取り除かない）"""
+    os.makedirs(data_dir, exist_ok=True)
+    manifest = load_manifest(data_dir)
+    known_games = [key for shard in manifest['shards'] for key in shard['games']]
+    next_seed = manifest.get('next_seed', len(known_games))
+    if seed is None:
+        seed = next_seed
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    seeds = [seed + i for i in range(n_games)]
+    run = manifest['runs']
+    tasks = [(data_dir, 'shard-%04d-w%02d' % (run, wid), seeds[wid::n_workers], thinker_names, known_games)
+             for wid in range(n_workers)]
+    with multiprocessing.Pool(n_workers) as pool:
+        results = pool.map(generate_worker, tasks)
+    n_duplicates = 0
+    for shards, duplicates in results:
+        manifest['shards'].extend(shard for shard in shards if shard['records'] > 0)
+        n_duplicates = n_duplicates + duplicates
+    manifest['runs'] = run + 1
+    manifest['next_seed'] = max(next_seed, seed + n_games)
+    save_manifest(data_dir, manifest)
+    return manifest, n_duplicates
+
+
+class ShardReader:
+    """1つのシャードを mmap で開き、行をランダムな順に読み出すクラス"""
+
+    def __init__(self, path: str, n_records: int, rng: random.Random):
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.order = list(range(n_records))  # 読み出す行の順番
+        rng.shuffle(self.order)
+
+    def read(self) -> Tuple[int, ...]:
+        """まだ読んでいない行を1つ返す"""
+        ix = self.order.pop()
+        return struct.unpack_from(RECORD_FORMAT, self.mm, NPY_HEADER_BYTES + ix * RECORD_BYTES)
+
+    def is_empty(self) -> bool:
+        return len(self.order) == 0
+
+    def close(self) -> None:
+        self.mm.close()
+        self.file.close()
+
+
+def iter_positions(data_dir: str, shuffle_buffer: int = SHUFFLE_BUFFER, seed: int = None) -> Iterator[Tuple[int, ...]]:
+    """マニフェストにある全シャードの行を、シャードをまたいでシャッフルしながら1行ずつ返す。
+    同時に開くのはOPEN_SHARDS個のシャードとshuffle_buffer行だけなので、全データをメモリに載せることはない"""
+    rng = random.Random(seed)
+    shards = [shard for shard in load_manifest(data_dir)['shards'] if shard['records'] > 0]
+    rng.shuffle(shards)
+    readers = []
+    buffer = []
+    while len(shards) > 0 or len(readers) > 0:
+        while len(shards) > 0 and len(readers) < OPEN_SHARDS:
+            shard = shards.pop()
+            readers.append(ShardReader(os.path.join(data_dir, shard['file']), shard['records'], rng))
+        reader = rng.choice(readers)
+        buffer.append(reader.read())
+        if reader.is_empty():
+            reader.close()
+            readers.remove(reader)
+        if len(buffer) >= shuffle_buffer:
+            # バッファからランダムに1行取り出して返す（末尾と入れ替えてからpop）
+            ix = rng.randrange(len(buffer))
+            buffer[ix], buffer[-1] = buffer[-1], buffer[ix]
+            yield buffer.pop()
+    rng.shuffle(buffer)
+    for row in buffer:
+        yield row
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Geister self-play training data')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_generate = subparsers.add_parser('generate', help='self-play and append positions to data_dir')
+    parser_generate.add_argument('data_dir')
+    parser_generate.add_argument('--games', type=int, default=1000)
+    parser_generate.add_argument('--workers', type=int, default=None)
+    parser_generate.add_argument('--thinkers', nargs=2, default=['rules1', 'rules1'], choices=sorted(gw.THINKERS))
+    parser_generate.add_argument('--seed', type=int, default=None, help='default: continue after the last run')
+    parser_stats = subparsers.add_parser('stats', help='show summary of data_dir')
+    parser_stats.add_argument('data_dir')
+    args = parser.parse_args()
+    if args.command == 'generate':
+        manifest, n_duplicates = generate(args.data_dir, args.games, args.workers, tuple(args.thinkers), args.seed)
+        print('skipped %d duplicate games' % n_duplicates)
+    elif args.command == 'stats':
+        manifest = load_manifest(args.data_dir)
+    else:
+        parser.print_help()
+        return
+    n_records = sum(shard['records'] for shard in manifest['shards'])
+    n_games = sum(len(shard['games']) for shard in manifest['shards'])
+    print('shards: %d, games: %d, positions: %d' % (len(manifest['shards']), n_games, n_records))
+
+
+if __name__ == '__main__':
+    main()
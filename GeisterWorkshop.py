@@ -9,10 +9,16 @@ written by matsubara@morikatron.co.jp
 """
 
 from enum import Enum
-from typing import List, Tuple, Union
+from typing import Callable, List, Tuple, Union
+import argparse
+import json
+import os
 import random
 import re
 import pickle
+import sqlite3
+import sys
+import time
 
 # ゲームの基本的な枠組みや表現に関する各種の定数を宣言
 BOARD_WIDTH = 6  # ボードの幅
@@ -30,6 +36,13 @@ COL_U = 0.0  # 不明
 
 CAPTURE_ABOVE_E_COLOR_ALL = COL_R + 0.1  # 「赤確実のコマは捕獲しない」ときに使う capture_above_e_color 値
 CAPTURE_ABOVE_E_COLOR_ONLY_BLUE = COL_B  # 「青確実のコマなら捕獲する」ときに使う capture_above_e_color 値
+CAPTURE_ABOVE_E_COLOR_PRIOR = -0.5  # 相手モデルを使うときの attack_capture_above_e_color 値（攻めの途中では「統計上、赤の疑いが強いコマ」を捕獲しない）
+PRIOR_EXPLORATION = 0.25  # 相手モデルがあっても、この確率で CAPTURE_ABOVE_E_COLOR_PRIOR を使わずに対局する（赤の疑いが強いコマの色も、ときどき取って確かめるため）
+
+# 対戦相手ごとの統計（相手モデル）に関する定数
+OPPONENT_DB_PATH = 'geister_opponents.sqlite3'  # 相手モデルを保存するSQLiteのファイル
+PRIOR_STRENGTH = 4.0  # 統計から事前値を作るときに、何局分を「赤青半々」とみなして混ぜるか（局数が少ないうちは0に近い値になる）
+PRIOR_LIMIT = 0.8  # 事前値の上限。統計だけでは「確実に赤（青）」とはしない
 
 # 表示制御に関する定数
 """
@@ -72,7 +85,7 @@ class Piece:
         self.y = y  # y座標
         self.color = col  # 色
         self.e_color = 0.0  # COL_Uの推測値 Estimated value を保持。　COL_R <= e_color <= COL_B の値をとるとする。
-        # ただし現在のこのプログラムでは e_color を更新していない（つまり「赤の疑い」度を算出していない）。
+        # ただし現在のこのプログラムでは、相手モデル（OpponentModel）の事前値を入れる以外は e_color を更新していない。
         # 敵コマの推定方法を考えてe_colorを更新するコードを追加すれば、より強くなるはずです。
 
     def get_color_string(self) -> str:
@@ -216,11 +229,120 @@ class Game:
         # 相手コマの推定色 e_color < capture_above_e_color なら捕獲できない、と判断する。
         # なんでも取っていい場合は capture_above_e_color = COL_R + 0.1 とかにしておく。（「確実に赤コマ」は捕獲しない）
         # 赤３つ取っちゃった後は capture_above_e_color = COL_B にしておく。（「確実に青コマ」を捕獲）
+        self.attack_capture_above_e_color = CAPTURE_ABOVE_E_COLOR_ALL  # think_attack()で攻めるときだけ、capture_above_e_colorに加えて使う閾値。
+        # 相手モデルの事前値で赤の疑いが強いコマを、攻めの途中では取らないようにするために使う（自陣の角の敵コマを取る move_to_no_lose() には使わない）
+        self.op_move_order = []  # 敵のコマが初めて動いた順に、そのコマの番号を記録
+        self.first_mover_priors = []  # k番目に初めて動いた敵コマのe_colorに足す値（相手モデルから読み込む）
+        self.plan = None  # 思考ルーチンが一局を通して使う作戦（GeisterCFR.think_cfr()が対局の最初に決める）
+        self.history = []  # 打たれた手を (which_player, piece_ix, direction) の形で記録
+
+
+class OpponentModel:
+    """対戦相手ごとの統計をSQLiteに記録して、次の対局で敵コマのe_colorの事前値にするクラス。
+    DBを読むのは対局開始時、書くのは対局終了時にまとめて1回だけなので、1手ごとの思考時間には影響しない。"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS games (
+            id INTEGER PRIMARY KEY,
+            opponent TEXT NOT NULL,
+            first_player INTEGER NOT NULL,
+            n_moved INTEGER NOT NULL,
+            result INTEGER NOT NULL,
+            layout TEXT NOT NULL,
+            move_order TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS games_opponent ON games (opponent);
+        CREATE TABLE IF NOT EXISTS slot_stats (
+            opponent TEXT NOT NULL,
+            ix INTEGER NOT NULL,
+            n_red INTEGER NOT NULL DEFAULT 0,
+            n_blue INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (opponent, ix)
+        );
+        CREATE TABLE IF NOT EXISTS order_stats (
+            opponent TEXT NOT NULL,
+            k INTEGER NOT NULL,
+            n_red INTEGER NOT NULL DEFAULT 0,
+            n_blue INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (opponent, k)
+        );
+    """
+
+    def __init__(self, name: str, path: str = OPPONENT_DB_PATH):
+        self.name = name  # 対戦相手の名前
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(OpponentModel.SCHEMA)
+
+    def count_games(self) -> int:
+        """この相手と記録した対局の数を返す"""
+        row = self.connection.execute('SELECT COUNT(*) FROM games WHERE opponent = ?', (self.name,)).fetchone()
+        return row[0]
+
+    def load_priors(self) -> Tuple[List[float], List[float]]:
+        """(コマ番号ごとのe_colorの事前値, k番目に初めて動いたコマのe_colorに足す値) を返す"""
+        slot_priors = [0.0] * MAX_PIECES
+        total_red = 0
+        total_blue = 0
+        for ix, n_red, n_blue in self.connection.execute(
+                'SELECT ix, n_red, n_blue FROM slot_stats WHERE opponent = ?', (self.name,)):
+            prior = (n_blue - n_red) / (n_red + n_blue + PRIOR_STRENGTH)
+            slot_priors[ix] = max(-PRIOR_LIMIT, min(PRIOR_LIMIT, prior))
+        # 動いた順番の統計は、全体の赤青の割合からどれだけずれているかを使う
+        order_rows = self.connection.execute(
+            'SELECT k, n_red, n_blue FROM order_stats WHERE opponent = ? ORDER BY k', (self.name,)).fetchall()
+        for k, n_red, n_blue in order_rows:
+            total_red = total_red + n_red
+            total_blue = total_blue + n_blue
+        base = (total_blue - total_red) / (total_red + total_blue + PRIOR_STRENGTH)
+        first_mover_priors = [0.0] * MAX_PIECES
+        for k, n_red, n_blue in order_rows:
+            first_mover_priors[k] = (n_blue - n_red) / (n_red + n_blue + PRIOR_STRENGTH) - base
+        return slot_priors, first_mover_priors
+
+    def record_game(self, game: Game) -> None:
+        """対局でわかったこと（捕獲で判明した初期配置の色、敵コマが動いた順番）を1回のトランザクションで記録する"""
+        op_pieces = game.players[OP].pieces
+        layout = ''.join('R' if piece.color == COL_R else 'B' if piece.color == COL_B else '?' for piece in op_pieces)
+        if game.game_state == GameState.won:
+            result = 1
+        elif game.game_state == GameState.lost:
+            result = -1
+        else:
+            result = 0
+        slot_rows = [(self.name, ix) for ix, piece in enumerate(op_pieces) if piece.color != COL_U]
+        slot_counts = [(int(piece.color == COL_R), int(piece.color == COL_B), self.name, ix)
+                       for ix, piece in enumerate(op_pieces) if piece.color != COL_U]
+        order_rows = [(self.name, k) for k, ix in enumerate(game.op_move_order) if op_pieces[ix].color != COL_U]
+        order_counts = [(int(op_pieces[ix].color == COL_R), int(op_pieces[ix].color == COL_B), self.name, k)
+                        for k, ix in enumerate(game.op_move_order) if op_pieces[ix].color != COL_U]
+        with self.connection:
+            self.connection.execute(
+                'INSERT INTO games (opponent, first_player, n_moved, result, layout, move_order) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (self.name, game.first_player, game.n_moved, result, layout,
+                 ','.join(str(ix) for ix in game.op_move_order)))
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO slot_stats (opponent, ix) VALUES (?, ?)', slot_rows)
+            self.connection.executemany(
+                'UPDATE slot_stats SET n_red = n_red + ?, n_blue = n_blue + ? WHERE opponent = ? AND ix = ?',
+                slot_counts)
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO order_stats (opponent, k) VALUES (?, ?)', order_rows)
+            self.connection.executemany(
+                'UPDATE order_stats SET n_red = n_red + ?, n_blue = n_blue + ? WHERE opponent = ? AND k = ?',
+                order_counts)
+
+    def close(self) -> None:
+        self.connection.close()
 
 
 # グローバル変数
 g = Game()  # 現在のゲーム状態すべて
 g_stack = []  # ゲーム状態を保存しておくスタック
+opponent_model = None  # 対戦相手の名前を指定して起動したときの相手モデル（OpponentModel）
+game_log_path = None  # 対局の記録を追記するファイル（--recordで指定したとき）
+layout_sampler = None  # AIの初期配置（コマ番号順の色のリスト）を返す関数。指定があればreset_game()がこれで配置を決める
+ai_thinker = None  # AIの思考ルーチン。指定があればthink()がこれを使う（--cfrで起動したときはGeisterCFR.think_cfr）
 
 
 def push_game() -> None:
@@ -358,10 +480,16 @@ def reset_game() -> None:
     g_stack = []  # ゲーム状態を保存しておくスタックをクリアする
     g.game_state = GameState.enter_f_or_s  # 現在のゲームの状態を保持する変数
     g.last_move = None  # 最後に動かした手
+    g.n_moved = 0  # 何手まで打ったか
+    g.capture_above_e_color = CAPTURE_ABOVE_E_COLOR_ALL  # AIの捕獲行動を制御する閾値
+    g.attack_capture_above_e_color = CAPTURE_ABOVE_E_COLOR_ALL  # 攻めるときだけ使う捕獲の閾値
+    g.op_move_order = []  # 敵のコマが初めて動いた順番
+    g.plan = None  # 一局を通して使う作戦
+    g.history = []  # 打たれた手
     """ ゲーム開始時のコマの配置場所を決めます
      012345
-    0 0123 5  　　←　こちらが敵側とします
-    1 4567 4
+    0 7654 5  　　←　こちらが敵側とします（自分側を180度回転させた並びなので、番号の順も逆になります）
+    1 3210 4
     2      3
     3      2
     4 0123 1　　　←　こちらが自分側とします
@@ -375,12 +503,25 @@ def reset_game() -> None:
         Piece(1, 4, COL_R), Piece(2, 4, COL_R), Piece(3, 4, COL_R), Piece(4, 4, COL_R),
         Piece(1, 5, COL_B), Piece(2, 5, COL_B), Piece(3, 5, COL_B), Piece(4, 5, COL_B)
     ])
+    # 初期配置を決める関数が指定されていれば（--cfrで起動したときなど）、その配置に塗り替えます
+    if layout_sampler is not None:
+        for piece, color in zip(me.pieces, layout_sampler()):
+            piece.color = color
     # 相手（敵）のコマ情報を保持するplayerを作ります
     # 敵のコマは色が不明なのでCOL_Uで全部並べます
+    # 自分のコマを180度回転させた位置に同じ番号順で並べます（相手から見たコマ番号と一致させるため）
     op = Player(which_player=OP, pieces=[
-        Piece(1, 0, COL_U), Piece(2, 0, COL_U), Piece(3, 0, COL_U), Piece(4, 0, COL_U),
-        Piece(1, 1, COL_U), Piece(2, 1, COL_U), Piece(3, 1, COL_U), Piece(4, 1, COL_U)
+        Piece(BOARD_WIDTH - 1 - piece.x, BOARD_HEIGHT - 1 - piece.y, COL_U) for piece in me.pieces
     ])
+    # 相手モデルがあれば、過去の対局の統計から敵コマのe_colorの事前値を入れておきます
+    if opponent_model is not None:
+        slot_priors, g.first_mover_priors = opponent_model.load_priors()
+        for piece, prior in zip(op.pieces, slot_priors):
+            piece.e_color = prior
+        # 攻めの途中では、事前値が十分に赤寄りのコマは取らないようにします
+        # ただし、ときどき（PRIOR_EXPLORATIONの確率で）はそうしない対局をして、そのコマの色も統計に入るようにします
+        if random.random() >= PRIOR_EXPLORATION:
+            g.attack_capture_above_e_color = CAPTURE_ABOVE_E_COLOR_PRIOR
     # playerリストに保存します
     g.players = [me, op]
     # 最初のまっさらなゲーム状態をスタックに退避しておく
@@ -433,8 +574,10 @@ def find_piece_from_xy(x: int, y: int) -> Union[Tuple[int, None], Tuple[int, Pie
     return NO_PLAYER, None
 
 
-def is_correct_move(move: Move) -> bool:
-    """手が適正かどうかを判定します"""
+def is_correct_move(move: Move, capture_above_e_color: float = None) -> bool:
+    """手が適正かどうかを判定します。capture_above_e_colorを省略すると g.capture_above_e_color を捕獲の閾値に使います"""
+    if capture_above_e_color is None:
+        capture_above_e_color = g.capture_above_e_color
     if move.piece_ix < 0 or move.piece_ix >= MAX_PIECES:
         return False
     target_piece = g.players[move.which_player].pieces[move.piece_ix]
@@ -463,9 +606,9 @@ def is_correct_move(move: Move) -> bool:
     which_player, target_piece = find_piece_from_xy(move.x_after_move, move.y_after_move)
     if move.which_player == which_player:  # 移動先に自分のコマがいるなら、の条件判定
         return False
-    # 自コマの移動チェックの場合、e_color < g.capture_above_e_color の場合は捕獲できない、とする。
+    # 自コマの移動チェックの場合、e_color < capture_above_e_color の場合は捕獲できない、とする。
     if which_player == OP:
-        if target_piece.e_color < g.capture_above_e_color:
+        if target_piece.e_color < capture_above_e_color:
             return False
     # 上記以外の条件ならTrue（適正な打ち手）と判断してTrueを返す
     return True
@@ -475,9 +618,17 @@ def execute_move(move: Move) -> Union[Piece, None]:
     """打ち手を実行して盤面をアップデートする。与えられた手Moveは適正なものとする（事前にis_correct_moveでチェック済みであるとする）。とったコマを返す"""
     g.last_move = move
     g.n_moved = g.n_moved + 1
+    g.history.append((move.which_player, move.piece_ix, move.direction))
     target_piece = g.players[move.which_player].pieces[move.piece_ix]
     # 移動先にコマがあれば、それを発見しておく
     which_player, captured_piece = find_piece_from_xy(move.x_after_move, move.y_after_move)
+    # 敵コマが初めて動いたなら、その順番を記録して、相手モデルの「k番目に動くコマ」の傾向をe_colorに反映する
+    if move.which_player == OP and move.piece_ix not in g.op_move_order:
+        k = len(g.op_move_order)
+        g.op_move_order.append(move.piece_ix)
+        if k < len(g.first_mover_priors):
+            e_color = target_piece.e_color + g.first_mover_priors[k]
+            target_piece.e_color = max(-PRIOR_LIMIT, min(PRIOR_LIMIT, e_color))
     # 次にコマを移動する
     target_piece.x = move.x_after_move
     target_piece.y = move.y_after_move
@@ -607,7 +758,40 @@ def process_command(cmd: str) -> bool:
     return False
 
 
+def finish_game() -> None:
+    """対局を終える。相手モデルがあれば、この対局でわかったことをまとめて記録する。記録ファイルがあれば対局を追記する"""
+    if g.n_moved <= 0:
+        return
+    if opponent_model is not None:
+        opponent_model.record_game(g)
+    if game_log_path is not None:
+        opponent_name = 'opponent' if opponent_model is None else opponent_model.name
+        save_game_records(game_log_path, [GameRecord.from_game(g, ['AI', opponent_name])])
+
+
 def main():
+    global opponent_model, game_log_path, layout_sampler, ai_thinker
+    parser = argparse.ArgumentParser(description='Geister program for Board game AI Workshop #1')
+    parser.add_argument('opponent', nargs='?', default=None,
+                        help='対戦相手の名前。指定すると相手ごとの統計を記録して、次の対局から敵コマの色の推定に使います')
+    parser.add_argument('--record', default=None,
+                        help='対局を終えるたびに、その記録を追記するファイル（GeisterAnalysis.pyで解析できます）')
+    parser.add_argument('--cfr', default=None,
+                        help='GeisterCFR.pyで求めた戦略のファイル。指定すると初期配置と作戦をその戦略に従って決めます')
+    args = parser.parse_args()
+    game_log_path = args.record
+    if args.cfr is not None:
+        # スクリプトとして実行しているときは、GeisterCFRが import GeisterWorkshop で別のコピーを読み込んでしまうので、
+        # 実行中のこのモジュールをそのまま使わせる
+        sys.modules['GeisterWorkshop'] = sys.modules[__name__]
+        import GeisterCFR
+        GeisterCFR.load_strategy(args.cfr)
+        layout_sampler = GeisterCFR.sample_layout
+        ai_thinker = GeisterCFR.think_cfr
+        print('strategy: ' + args.cfr)
+    if args.opponent is not None:
+        opponent_model = OpponentModel(args.opponent)
+        print('opponent: ' + args.opponent + ' (' + str(opponent_model.count_games()) + ' games recorded)')
     random.seed()  # 乱数の初期化
     reset_game()
     while True:
@@ -624,6 +808,7 @@ def main():
             cmd = cmd.lower()
             # 終了コマンドの検出と処理
             if cmd in {'quit', 'q'}:
+                finish_game()
                 break
             # ヘルプコマンドの検出と処理
             if cmd in {'help', 'h', '?'}:
@@ -631,6 +816,7 @@ def main():
                 continue
             # endコマンドの検出と処理
             if cmd in {'e', 'end', 'finish', 'restart', 'new'}:
+                finish_game()
                 reset_game()
                 continue
             # Undoコマンドの検出と処理
@@ -658,6 +844,8 @@ def think_attack(color: float) -> Move:
             target_piece_indexes.append(pix)
     # シャッフルする（動かそうとするコマをランダムに選択するため）
     random.shuffle(target_piece_indexes)
+    # 攻めの途中では、相手モデルで赤の疑いが強いコマも取らない
+    capture_above_e_color = max(g.capture_above_e_color, g.attack_capture_above_e_color)
     # できるだけ北へ動かそうとトライ
     for pix in target_piece_indexes:
         # newsの順に動く方角を試してOKなら打ち手を返す
@@ -665,7 +853,7 @@ def think_attack(color: float) -> Move:
             move = Move(which_player=ME,
                         piece_ix=pix,
                         direction=direction)
-            if is_correct_move(move):
+            if is_correct_move(move, capture_above_e_color):
                 return move
         # どの方角にも動けなかった場合はここまで落ちてきて、次のコマを試す
     # すべての指定色コマが動けない状態はここまで落ちてくるので、ランダムな手を返す
@@ -745,8 +933,9 @@ def move_to_no_lose() -> Union[Move, None]:
     return None
 
 
-def think_various_rules_1() -> Move:
-    """ちょっと複雑なことを考えながら打ってみる"""
+def think_various_rules_1(lead_color: float = COL_R, capture_limit: int = 3, lead_moves: int = 20) -> Move:
+    """ちょっと複雑なことを考えながら打ってみる。
+    序盤（lead_moves手まで）に攻めるコマの色lead_colorと、捕獲をやめる敵の赤の数capture_limitを変えられる"""
     # 必勝状態ならそれを逃さない（青コマが敵陣抜けられるなら絶対抜ける）
     move = move_to_win()
     if move is not None:
@@ -755,12 +944,12 @@ def think_various_rules_1() -> Move:
     move = move_to_no_lose()
     if move is not None:
         return move
-    # 敵の赤を3個取ってしまったら、赤の疑いがあるコマを取らないようにする
-    if g.players[OP].n_captured_red >= 3:
+    # 敵の赤を3個（capture_limit個）取ってしまったら、赤の疑いがあるコマを取らないようにする
+    if g.players[OP].n_captured_red >= capture_limit:
         g.capture_above_e_color = CAPTURE_ABOVE_E_COLOR_ONLY_BLUE
-    # 20手までは赤コマだけで攻める
-    if g.n_moved < 20:
-        return think_attack(COL_R)
+    # 20手（lead_moves手）までは赤コマ（lead_colorのコマ）だけで攻める
+    if g.n_moved < lead_moves:
+        return think_attack(lead_color)
     # 20手目以降は赤コマ青コマの残りが多い方（同数ならランダムで決定）で攻める
     if g.players[ME].n_alive_red > g.players[ME].n_alive_blue:
         return think_attack(COL_R)
@@ -780,14 +969,637 @@ def think_various_rules_1() -> Move:
 def think() -> Move:
     """現在のゲーム状況から、AIの最善の打ち手を考え、Moveを作成して返す"""
     while True:
-        # move = think_random()  # ランダムな手を選ぶパターン
-        # move = think_attack(COL_R)  # 赤だけで攻めていくパターン
-        move = think_various_rules_1()  # もうちょっと複雑な攻め方をするパターン
+        if ai_thinker is not None:  # 起動時に思考ルーチンが指定されていれば（--cfrなど）、それを使う
+            move = ai_thinker()
+        else:
+            # move = think_random()  # ランダムな手を選ぶパターン
+            # move = think_attack(COL_R)  # 赤だけで攻めていくパターン
+            # move = think_monte_carlo(time_limit=1.0)  # 1秒間ランダムな打ち合いを試して、結果が良い手を選ぶパターン
+            # move = think_expectimax(iterations=4, time_limit=1.0)  # 敵コマの色を確率として扱いながら4手先まで（1秒まで）先読みするパターン
+            move = think_various_rules_1()  # もうちょっと複雑な攻め方をするパターン
         # 打ち手が正しければループを抜ける
         if is_correct_move(move):
             break
     return move
 
 
+"""AI同士の自己対戦"""
+
+MAX_PLIES = 200  # 両者の手数の合計がこれに達したら引き分けとする
+THINK_RETRY = 100  # 思考ルーチンが適正な手を返すまで試す回数の上限
+INITIAL_XY = [(1, 4), (2, 4), (3, 4), (4, 4), (1, 5), (2, 5), (3, 5), (4, 5)]  # 自分のコマの初期位置（コマ番号順）
+FLIP_DIRECTION = {'n': 's', 'e': 'w', 'w': 'e', 's': 'n'}  # 盤面を180度回して相手側から見た時の方角
+THINKERS = {  # 名前で指定できる思考ルーチン（プロセスをまたいで指定するときは名前で渡す）
+    'random': think_random,
+    'rules1': think_various_rules_1,
+}
+
+
+class GameRecord:
+    """自己対戦1局分の記録を保持するクラス。
+    sideは対戦する二人を 0, 1 で表す番号。打ち手の方角は、動かした側から見た方角で記録する。"""
+
+    def __init__(self, layouts: List[List[float]], first_player: int = 0):
+        self.layouts = layouts  # 各sideの初期配置（コマ番号順の色のリスト）
+        self.first_player = first_player  # 先手のside
+        self.moves = []  # (side, piece_ix, direction) のリスト
+        self.winner = NO_PLAYER  # 勝ったside。引き分けならNO_PLAYER
+        self.think_time = [0.0, 0.0]  # 各sideが思考に使ったCPU時間（秒）
+        self.names = ['', '']  # 各sideの思考ルーチン（またはプレイヤー）の名前
+
+    @classmethod
+    def from_game(cls, game: Game, names: List[str]):
+        """AI視点のゲーム状態（人間との対局）から記録を作る。AIがside 0、相手がside 1。
+        相手の初期配置は、捕獲して色がわかったコマ以外はCOL_Uのまま"""
+        record = cls([[piece.color for piece in p.pieces] for p in game.players],
+                     0 if game.first_player == ME else 1)
+        for which_player, piece_ix, direction in game.history:
+            if which_player == OP:
+                direction = FLIP_DIRECTION[direction]  # 相手から見た方角にする
+            record.moves.append((which_player, piece_ix, direction))
+        if game.game_state == GameState.won:
+            record.winner = 0
+        elif game.game_state == GameState.lost:
+            record.winner = 1
+        record.names = list(names)
+        return record
+
+    def to_dict(self) -> dict:
+        """JSONに書き出せるdictにして返す"""
+        return {'layouts': self.layouts, 'first_player': self.first_player, 'moves': self.moves,
+                'winner': self.winner, 'think_time': self.think_time, 'names': self.names}
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        """to_dict()の結果から記録を作る"""
+        record = cls(d['layouts'], d['first_player'])
+        record.moves = [tuple(move) for move in d['moves']]
+        record.winner = d['winner']
+        record.think_time = d.get('think_time', [0.0, 0.0])
+        record.names = d.get('names', ['', ''])
+        return record
+
+
+def replace_file(path: str, data: bytes) -> None:
+    """ファイルをdataで置き換える（書きかけの状態が残らないよう、一時ファイルに書いてから置き換える）"""
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def save_game_records(path: str, records: List[GameRecord]) -> None:
+    """対局の記録を、1行1局のJSONでファイルに追記する"""
+    with open(path, 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record.to_dict()) + '\n')
+
+
+def load_game_records(path: str) -> List[GameRecord]:
+    """save_game_records()で書いたファイルから対局の記録を読み込む"""
+    with open(path, encoding='utf-8') as f:
+        return [GameRecord.from_dict(json.loads(line)) for line in f if line.strip() != '']
+
+
+def random_layout() -> List[float]:
+    """赤4個、青4個をランダムに並べた初期配置（コマ番号順の色のリスト）を返す"""
+    layout = [COL_R] * (MAX_PIECES // 2) + [COL_B] * (MAX_PIECES // 2)
+    random.shuffle(layout)
+    return layout
+
+
+def make_game(layout: List[float]) -> Game:
+    """自分の初期配置から、reset_game()と同じ並びで自分視点のゲーム状態を作って返す（相手のコマ色は不明）"""
+    game = Game()
+    me = Player(which_player=ME, pieces=[Piece(x, y, col) for (x, y), col in zip(INITIAL_XY, layout)])
+    op = Player(which_player=OP, pieces=[
+        Piece(BOARD_WIDTH - 1 - x, BOARD_HEIGHT - 1 - y, COL_U) for x, y in INITIAL_XY
+    ])
+    game.players = [me, op]
+    return game
+
+
+def make_views(record: GameRecord) -> List[Game]:
+    """対局開始時の、side 0 から見たゲーム状態と side 1 から見たゲーム状態を作って返す"""
+    views = [make_game(record.layouts[0]), make_game(record.layouts[1])]
+    views[record.first_player].first_player = ME
+    views[1 - record.first_player].first_player = OP
+    return views
+
+
+def apply_view_move(views: List[Game], side: int, piece_ix: int, direction: str) -> None:
+    """sideの打ち手を両者の視点のゲーム状態に反映する。コマを取った場合は、取った側の視点でそのコマの色を明かす"""
+    global g
+    g = views[side]
+    captured_piece = execute_move(Move(which_player=ME, piece_ix=piece_ix, direction=direction))
+    g = views[1 - side]
+    lost_piece = execute_move(Move(which_player=OP, piece_ix=piece_ix, direction=FLIP_DIRECTION[direction]))
+    if captured_piece is not None:
+        captured_piece.color = lost_piece.color
+
+
+def list_correct_moves() -> List[Move]:
+    """現在のゲーム状態で、AIが打てる適正な手をすべて返す"""
+    moves = []
+    for pix, piece in enumerate(g.players[ME].pieces):
+        if 0 <= piece.x < BOARD_WIDTH:
+            for direction in Move.news:
+                move = Move(which_player=ME, piece_ix=pix, direction=direction)
+                if is_correct_move(move):
+                    moves.append(move)
+    return moves
+
+
+def think_with(thinker: Callable[[], Move]) -> Union[Move, None]:
+    """think()と同じく適正な手が出るまでthinkerに考えさせる。
+    THINK_RETRY回やってもだめならランダムな適正手を、打てる手がなければNoneを返す"""
+    moves = list_correct_moves()
+    if len(moves) == 0:
+        return None
+    for _ in range(THINK_RETRY):
+        move = thinker()
+        if is_correct_move(move):
+            return move
+    return random.choice(moves)
+
+
+def play_game(thinkers: List[Callable[[], Move]],
+              layouts: List[List[float]] = None,
+              first_player: int = 0,
+              max_plies: int = MAX_PLIES,
+              callback: Callable[[List[Game], int, Move], None] = None) -> GameRecord:
+    """thinkers[0]とthinkers[1]を自己対戦させて、その記録を返す。
+    各sideの思考ルーチンは、そのsideから見たゲーム状態が g に入った状態で呼ばれる。
+    callback(views, side, move) は、各手を打つ直前に呼ばれる。"""
+    global g
+    saved_g = g  # 対戦中は g を差し替えるので、終わったら元に戻す
+    if layouts is None:
+        layouts = [random_layout(), random_layout()]
+    record = GameRecord(layouts, first_player)
+    views = make_views(record)
+    side = first_player
+    try:
+        while len(record.moves) < max_plies:
+            g = views[side]
+            start = time.process_time()
+            move = think_with(thinkers[side])
+            record.think_time[side] += time.process_time() - start
+            if move is None:  # 打てる手がなければ引き分け
+                break
+            if callback is not None:
+                callback(views, side, move)
+            record.moves.append((side, move.piece_ix, move.direction))
+            apply_view_move(views, side, move.piece_ix, move.direction)
+            g = views[0]
+            if is_game_over():
+                record.winner = 0 if g.game_state == GameState.won else 1
+                break
+            side = 1 - side
+    finally:
+        g = saved_g
+    return record
+
+
+"""探索のための軽量な盤面と、予算（反復回数または時間）つきの思考ルーチン"""
+
+SIM_CAPTURED = -1  # SimStateで捕獲されたコマのマス番号
+SIM_ESCAPED = -2  # SimStateで脱出したコマのマス番号
+DIRECTION_DXDY = {'n': (0, -1), 'e': (1, 0), 'w': (-1, 0), 's': (0, 1)}  # 方角ごとの座標の変化
+MC_PLAYOUTS = 200  # think_monte_carlo()で予算の指定がないときのプレイアウト回数
+MC_PLAYOUT_DEPTH = 60  # プレイアウトで打つ手数の上限。ここで打ち切ったら引き分け扱い
+
+
+def blue_probability(e_color: float, n_red: int, n_blue: int) -> float:
+    """色が不明な敵コマが青である確率を返す。
+    n_red, n_blueは色が不明な敵コマに残っている赤と青の数。その比率をe_colorで補正する。"""
+    if n_blue <= 0:
+        return 0.0
+    if n_red <= 0 or e_color >= COL_B:
+        return 1.0
+    if e_color <= COL_R:
+        return 0.0
+    odds = (n_blue / n_red) * (1.0 + e_color) / (1.0 - e_color)
+    return odds / (1.0 + odds)
+
+
+class SimState:
+    """探索用の軽量な盤面を保持するクラス。
+    コマ番号 0〜7 が自分（ME）のコマ、8〜15 が敵（OP）のコマ。マス番号は自分視点で y * BOARD_WIDTH + x。
+    Game と違ってグローバル変数 g を使わないので、手を打ったり戻したりを高速に繰り返せる。"""
+
+    def __init__(self, squares: List[int], colors: List[float], e_colors: List[float], side: int = ME):
+        self.squares = squares  # 各コマのマス番号。捕獲済みはSIM_CAPTURED、脱出済みはSIM_ESCAPED
+        self.colors = colors  # 各コマの色。わからない敵コマはCOL_U
+        self.e_colors = e_colors  # 各コマの推定色（Piece.e_color）
+        self.side = side  # 手番のプレイヤー（ME or OP）
+        self.board = [-1] * (BOARD_WIDTH * BOARD_HEIGHT)  # マスごとのコマ番号。空きマスは-1
+        self.n_captured = [[0, 0], [0, 0]]  # n_captured[プレイヤー][0:赤 1:青] 捕獲された数
+        self.escaped = NO_PLAYER  # 脱出に成功したプレイヤー
+        for k, sq in enumerate(squares):
+            if sq >= 0:
+                self.board[sq] = k
+            elif sq == SIM_CAPTURED and colors[k] != COL_U:
+                self.n_captured[k // MAX_PIECES][int(colors[k] == COL_B)] += 1
+            elif sq == SIM_ESCAPED:
+                self.escaped = k // MAX_PIECES
+
+    @classmethod
+    def from_game(cls, game: Game):
+        """Game（AI視点）から、AIの手番のSimStateを作って返す"""
+        squares = []
+        colors = []
+        e_colors = []
+        for p in game.players:
+            for piece in p.pieces:
+                if piece.x == LOC_CAPTURED:
+                    squares.append(SIM_CAPTURED)
+                elif piece.x in {LOC_ESCAPED_W, LOC_ESCAPED_E}:
+                    squares.append(SIM_ESCAPED)
+                else:
+                    squares.append(piece.y * BOARD_WIDTH + piece.x)
+                colors.append(piece.color)
+                e_colors.append(piece.e_color)
+        return cls(squares, colors, e_colors, ME)
+
+    def copy(self):
+        return SimState(list(self.squares), list(self.colors), self.e_colors, self.side)
+
+    def legal_moves(self) -> List[Tuple[int, str, int]]:
+        """手番のプレイヤーが打てる手を (コマ番号, 方角, 移動先のマス番号またはSIM_ESCAPED) のリストで返す"""
+        moves = []
+        first = self.side * MAX_PIECES
+        goal_y = 0 if self.side == ME else BOARD_HEIGHT - 1  # 脱出できる行
+        for k in range(first, first + MAX_PIECES):
+            sq = self.squares[k]
+            if sq < 0:
+                continue
+            x = sq % BOARD_WIDTH
+            y = sq // BOARD_WIDTH
+            for direction in Move.news:
+                dx, dy = DIRECTION_DXDY[direction]
+                nx = x + dx
+                ny = y + dy
+                if 0 <= nx < BOARD_WIDTH and 0 <= ny < BOARD_HEIGHT:
+                    occupant = self.board[ny * BOARD_WIDTH + nx]
+                    if occupant < 0 or occupant // MAX_PIECES != self.side:
+                        moves.append((k, direction, ny * BOARD_WIDTH + nx))
+                elif y == goal_y and nx in {-1, BOARD_WIDTH} and self.colors[k] != COL_R:
+                    moves.append((k, direction, SIM_ESCAPED))
+        return moves
+
+    def play(self, move: Tuple[int, str, int]) -> Tuple[int, int, int]:
+        """手を打って手番を交代する。undo()に渡すための (コマ番号, 元のマス番号, 取ったコマ番号) を返す"""
+        k, direction, to = move
+        frm = self.squares[k]
+        captured = -1
+        self.board[frm] = -1
+        if to == SIM_ESCAPED:
+            self.escaped = self.side
+        else:
+            captured = self.board[to]
+            if captured >= 0:
+                self.squares[captured] = SIM_CAPTURED
+                self.n_captured[captured // MAX_PIECES][int(self.colors[captured] == COL_B)] += 1
+            self.board[to] = k
+        self.squares[k] = to
+        self.side = 1 - self.side
+        return k, frm, captured
+
+    def undo(self, undo_info: Tuple[int, int, int]) -> None:
+        """play()で打った手を戻す"""
+        k, frm, captured = undo_info
+        to = self.squares[k]
+        self.side = 1 - self.side
+        if to == SIM_ESCAPED:
+            self.escaped = NO_PLAYER
+        else:
+            self.board[to] = -1
+            if captured >= 0:
+                self.squares[captured] = to
+                self.board[to] = captured
+                self.n_captured[captured // MAX_PIECES][int(self.colors[captured] == COL_B)] -= 1
+        self.squares[k] = frm
+        self.board[frm] = k
+
+    def winner(self) -> int:
+        """勝敗が決まっていれば勝ったプレイヤーを、決まっていなければNO_PLAYERを返す（is_game_over()と同じ判定）"""
+        if self.escaped != NO_PLAYER:
+            return self.escaped
+        if self.n_captured[OP][1] >= 4 or self.n_captured[ME][0] >= 4:
+            return ME
+        if self.n_captured[OP][0] >= 4 or self.n_captured[ME][1] >= 4:
+            return OP
+        return NO_PLAYER
+
+    def unknown_counts(self) -> Tuple[int, int]:
+        """色が不明な敵コマに残っている (赤の数, 青の数) を返す"""
+        n_red = MAX_PIECES // 2
+        n_blue = MAX_PIECES // 2
+        for k in range(MAX_PIECES, 2 * MAX_PIECES):
+            if self.colors[k] == COL_R:
+                n_red = n_red - 1
+            elif self.colors[k] == COL_B:
+                n_blue = n_blue - 1
+        return n_red, n_blue
+
+    def determinize(self):
+        """色が不明な敵コマに、e_colorと残りの赤青の数に従ってランダムに色を割り当てたコピーを返す"""
+        state = self.copy()
+        n_red, n_blue = state.unknown_counts()
+        unknown = [k for k in range(MAX_PIECES, 2 * MAX_PIECES) if state.colors[k] == COL_U]
+        random.shuffle(unknown)
+        for k in unknown:
+            if random.random() < blue_probability(state.e_colors[k], n_red, n_blue):
+                state.colors[k] = COL_B
+                n_blue = n_blue - 1
+            else:
+                state.colors[k] = COL_R
+                n_red = n_red - 1
+            if state.squares[k] == SIM_CAPTURED:
+                state.n_captured[OP][int(state.colors[k] == COL_B)] += 1
+        return state
+
+
+def sim_move_of(state: SimState, move: Move) -> Tuple[int, str, int]:
+    """MoveをSimStateの手に変換する"""
+    for sim_move in state.legal_moves():
+        if sim_move[0] == move.piece_ix and sim_move[1] == move.direction:
+            return sim_move
+    return None
+
+
+def playout(state: SimState, depth: int = MC_PLAYOUT_DEPTH) -> float:
+    """色がすべて決まったstateから、脱出できるときは脱出し、それ以外はランダムに打ち合って、AIから見た結果を返す"""
+    for _ in range(depth):
+        winner = state.winner()
+        if winner != NO_PLAYER:
+            return 1.0 if winner == ME else -1.0
+        moves = state.legal_moves()
+        if len(moves) == 0:
+            return 0.0
+        escapes = [move for move in moves if move[2] == SIM_ESCAPED]
+        state.play(escapes[0] if len(escapes) > 0 else random.choice(moves))
+    winner = state.winner()
+    if winner == NO_PLAYER:
+        return 0.0
+    return 1.0 if winner == ME else -1.0
+
+
+def monte_carlo_values(moves: List[Move], iterations: int = None, time_limit: float = None) -> List[float]:
+    """現在のゲーム状態で、movesそれぞれのプレイアウトの平均値（AIから見て -1〜1）を返す。
+    プレイアウトは合計iterations回、またはtime_limit秒で打ち切る（どちらも指定がなければMC_PLAYOUTS回）"""
+    if iterations is None and time_limit is None:
+        iterations = MC_PLAYOUTS
+    root = SimState.from_game(g)
+    sim_moves = [sim_move_of(root, move) for move in moves]
+    totals = [0.0] * len(moves)
+    counts = [0] * len(moves)
+    deadline = None if time_limit is None else time.perf_counter() + time_limit
+    n = 0
+    while len(moves) > 0:
+        if iterations is not None and n >= iterations:
+            break
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+        i = n % len(moves)  # すべての手に順番にプレイアウトを割り当てる
+        state = root.determinize()
+        state.play(sim_moves[i])
+        totals[i] += playout(state)
+        counts[i] += 1
+        n = n + 1
+    return [total / count if count > 0 else 0.0 for total, count in zip(totals, counts)]
+
+
+def think_monte_carlo(iterations: int = None, time_limit: float = None) -> Move:
+    """敵コマの色をe_colorに従って決めつけた盤面でランダムに打ち合い、平均の結果が一番良い手を返す"""
+    moves = list_correct_moves()
+    if len(moves) == 0:
+        return think_random()
+    values = monte_carlo_values(moves, iterations, time_limit)
+    return moves[values.index(max(values))]
+
+
+"""敵コマの色を確率として扱う、深さ制限つきの探索（expectimax + alpha-beta）"""
+
+EXPECTIMAX_TIME_LIMIT = 1.0  # think_expectimax()で秒数の指定がないときの1手あたりの秒数（深さを指定したときも、この秒数で打ち切る）
+EXPECTIMAX_MAX_DEPTH = 30  # 反復深化で読む深さの上限
+WIN_VALUE = 1.0  # 勝ちの評価値（負けは -WIN_VALUE）。局面の評価関数はこれより内側の値を返す
+CHECK_TIME_EVERY = 64  # このノード数ごとに制限時間を確かめる
+
+
+class SearchTimeout(Exception):
+    """探索の制限時間を過ぎたことを知らせる例外"""
+    pass
+
+
+class ExpectimaxSearch:
+    """SimStateの上で、反復深化の alpha-beta 探索を行うクラス。
+    色が不明な敵コマを取る手は、e_colorから求めた青の確率で青の場合と赤の場合の期待値をとる（チャンスノード）。
+    色が不明な敵コマが自陣から脱出する手は、青なら負け、赤なら脱出できないので他の最善手、の期待値とする。
+    乱数を使わないので、同じ局面と同じ深さなら必ず同じ結果になる。"""
+
+    def __init__(self, root: SimState, deadline: float = None):
+        self.root = root  # 探索の開始局面（AIの手番）
+        self.deadline = deadline  # time.perf_counter()の値でこの時刻を過ぎたら探索を打ち切る
+        self.nodes = 0  # 探索したノード数
+
+    def check_time(self) -> None:
+        """制限時間を過ぎていたらSearchTimeoutを投げる"""
+        self.nodes = self.nodes + 1
+        if self.deadline is not None and self.nodes % CHECK_TIME_EVERY == 0 and time.perf_counter() >= self.deadline:
+            raise SearchTimeout()
+
+    def evaluate(self, state: SimState) -> float:
+        """勝敗が決まっていない局面の、AIから見た評価値（-0.9〜0.9）を返す"""
+        n_red, n_blue = state.unknown_counts()
+        value = 0.15 * (state.n_captured[OP][1] - state.n_captured[ME][1])  # 青を取る（取られる）のは良い（悪い）
+        value += 0.05 * (state.n_captured[ME][0] - state.n_captured[OP][0])  # 赤を取らせる（取る）のは良い（悪い）
+        # 脱出までの近さ。自分の青は一番近いもの、敵のコマは青らしさで重みをつけて一番危ないものを見る
+        my_escape = 0.0
+        for k in range(MAX_PIECES):
+            sq = state.squares[k]
+            if sq >= 0 and state.colors[k] == COL_B:
+                x = sq % BOARD_WIDTH
+                distance = min(x, BOARD_WIDTH - 1 - x) + sq // BOARD_WIDTH
+                my_escape = max(my_escape, 1.0 / (2 + distance))
+        op_escape = 0.0
+        for k in range(MAX_PIECES, 2 * MAX_PIECES):
+            sq = state.squares[k]
+            if sq >= 0:
+                x = sq % BOARD_WIDTH
+                distance = min(x, BOARD_WIDTH - 1 - x) + (BOARD_HEIGHT - 1 - sq // BOARD_WIDTH)
+                p = self.blue_probability(state, k, n_red, n_blue)
+                op_escape = max(op_escape, p / (2 + distance))
+        value += 0.4 * (my_escape - op_escape)
+        return max(-0.9, min(0.9, value))
+
+    @staticmethod
+    def blue_probability(state: SimState, k: int, n_red: int, n_blue: int) -> float:
+        """コマkが青である確率を返す"""
+        if state.colors[k] != COL_U:
+            return 1.0 if state.colors[k] == COL_B else 0.0
+        return blue_probability(state.e_colors[k], n_red, n_blue)
+
+    def ordered_moves(self, state: SimState) -> List[Tuple[int, str, int]]:
+        """手を、良さそうな順（脱出、青らしいコマの捕獲、青コマの前進、その他）に並べて返す"""
+        n_red, n_blue = state.unknown_counts()
+        forward = 'n' if state.side == ME else 's'
+
+        def priority(move):
+            k, direction, to = move
+            if to == SIM_ESCAPED:
+                return 3.0
+            target = state.board[to]
+            if target >= 0:
+                return 1.0 + self.blue_probability(state, target, n_red, n_blue)
+            if direction == forward and state.colors[k] != COL_R:
+                return 0.5
+            return 0.0
+        return sorted(state.legal_moves(), key=priority, reverse=True)
+
+    def move_value(self, state: SimState, move: Tuple[int, str, int], depth: int, alpha: float, beta: float) -> float:
+        """手を打った後の局面の評価値を返す。色が不明なコマを取る手は、青と赤の場合の期待値をとる"""
+        target = state.board[move[2]] if move[2] >= 0 else -1
+        if target >= 0 and state.colors[target] == COL_U:
+            n_red, n_blue = state.unknown_counts()
+            p = blue_probability(state.e_colors[target], n_red, n_blue)
+            value = 0.0
+            for color, probability in ((COL_B, p), (COL_R, 1.0 - p)):
+                if probability <= 0.0:
+                    continue
+                state.colors[target] = color
+                undo_info = state.play(move)
+                try:
+                    # チャンスノードの下は窓を狭めずに読む
+                    value += probability * self.search(state, depth - 1, -WIN_VALUE, WIN_VALUE)
+                finally:
+                    state.undo(undo_info)
+                    state.colors[target] = COL_U
+            return value
+        undo_info = state.play(move)
+        try:
+            return self.search(state, depth - 1, alpha, beta)
+        finally:
+            state.undo(undo_info)
+
+    def search(self, state: SimState, depth: int, alpha: float, beta: float) -> float:
+        """depth手先まで読んで、AIから見た局面の評価値を返す"""
+        self.check_time()
+        winner = state.winner()
+        if winner != NO_PLAYER:
+            return WIN_VALUE if winner == ME else -WIN_VALUE
+        if depth <= 0:
+            return self.evaluate(state)
+        moves = self.ordered_moves(state)
+        if len(moves) == 0:
+            return 0.0
+        if state.side == ME:
+            best = -WIN_VALUE
+            for move in moves:
+                best = max(best, self.move_value(state, move, depth, alpha, beta))
+                alpha = max(alpha, best)
+                if alpha >= beta:
+                    break
+            return best
+        # 敵の手番。色が不明なコマの脱出は、他の手の最善の値がわかってから期待値を計算する
+        unknown_escapes = [move for move in moves if move[2] == SIM_ESCAPED and state.colors[move[0]] == COL_U]
+        if len(unknown_escapes) > 0:
+            alpha = -WIN_VALUE  # 脱出の期待値の計算に正確な値が要るので、他の手も窓を狭めずに読む
+            beta = WIN_VALUE
+        best = WIN_VALUE
+        for move in moves:
+            if move in unknown_escapes:
+                continue
+            best = min(best, self.move_value(state, move, depth, alpha, beta))
+            beta = min(beta, best)
+            if alpha >= beta:
+                return best
+        if len(unknown_escapes) == len(moves):  # 脱出以外に打てる手がない
+            best = 0.0
+        n_red, n_blue = state.unknown_counts()
+        for move in unknown_escapes:
+            p = blue_probability(state.e_colors[move[0]], n_red, n_blue)
+            best = min(best, p * -WIN_VALUE + (1.0 - p) * best)
+        return best
+
+    def root_values(self, moves: List[Tuple[int, str, int]], depth: int, exact: bool) -> List[float]:
+        """ルートの各手をdepth手まで読んだ評価値を返す。
+        exactでなければ alpha-beta で最善手だけを正確に求める（他の手の値は上限値になる）"""
+        values = []
+        alpha = -WIN_VALUE
+        for move in moves:
+            value = self.move_value(self.root, move, depth, -WIN_VALUE if exact else alpha, WIN_VALUE)
+            values.append(value)
+            alpha = max(alpha, value)
+        return values
+
+    def iterate(self, moves: List[Tuple[int, str, int]], max_depth: int,
+                exact: bool = False) -> Tuple[List[float], List[int]]:
+        """深さ1から順に読んでいき、最後に読み終えた深さでの (各手の評価値, 良い順に並べた手の番号) を返す。
+        前の深さで良かった手から先に読むことで、alpha-beta の枝刈りが効きやすくなる。
+        制限時間を過ぎたら、読みかけの深さの結果は捨てる（1つも読み終えていなければ、手の並べ方の順になる）。"""
+        ordered = self.ordered_moves(self.root)
+        order = sorted(range(len(moves)), key=lambda i: ordered.index(moves[i]))
+        values = [0.0] * len(moves)
+        for depth in range(1, max_depth + 1):
+            try:
+                depth_values = self.root_values([moves[i] for i in order], depth, exact)
+            except SearchTimeout:
+                break
+            for i, value in zip(order, depth_values):
+                values[i] = value
+            order.sort(key=lambda i: values[i], reverse=True)
+            if abs(values[order[0]]) >= WIN_VALUE:  # 勝ち（負け）が読み切れたらそれ以上読まない
+                break
+        return values, order
+
+
+def expectimax_budget(iterations: int = None, time_limit: float = None) -> Tuple[int, float]:
+    """予算から (読む深さの上限, 打ち切る時刻) を返す。iterationsは読む深さとして扱う。
+    深さだけを指定しても、深く読みすぎて止まらなくならないよう、必ずEXPECTIMAX_TIME_LIMIT秒で打ち切る"""
+    if time_limit is None:
+        time_limit = EXPECTIMAX_TIME_LIMIT
+    max_depth = EXPECTIMAX_MAX_DEPTH if iterations is None else min(iterations, EXPECTIMAX_MAX_DEPTH)
+    deadline = time.perf_counter() + time_limit
+    return max_depth, deadline
+
+
+def expectimax_values(moves: List[Move], iterations: int = None, time_limit: float = None) -> List[float]:
+    """現在のゲーム状態で、movesそれぞれの評価値（AIから見て -1〜1）を反復深化で求めて返す。
+    iterationsは読む深さ、time_limitは秒数（指定がなければEXPECTIMAX_TIME_LIMIT秒）"""
+    max_depth, deadline = expectimax_budget(iterations, time_limit)
+    root = SimState.from_game(g)
+    search = ExpectimaxSearch(root, deadline)
+    values, order = search.iterate([sim_move_of(root, move) for move in moves], max_depth, exact=True)
+    return values
+
+
+def think_expectimax(iterations: int = None, time_limit: float = None) -> Move:
+    """敵コマの色を確率として扱いながら数手先まで読み、最善の手を返す。
+    制限時間を過ぎたら、最後に読み終えた深さでの最善手を返す。
+    乱数は使わないが、制限時間内にどの深さまで読めるかはマシンの負荷で変わるので、結果を再現できるのは
+    iterationsで深さを固定し、その深さを制限時間内に読み終えたときだけ"""
+    # think_various_rules_1()と同じく、敵の赤を3個取ってしまったら、赤の疑いがあるコマを取らないようにする
+    if g.players[OP].n_captured_red >= 3:
+        g.capture_above_e_color = CAPTURE_ABOVE_E_COLOR_ONLY_BLUE
+    moves = list_correct_moves()
+    if len(moves) == 0:
+        return think_random()
+    max_depth, deadline = expectimax_budget(iterations, time_limit)
+    root = SimState.from_game(g)
+    search = ExpectimaxSearch(root, deadline)
+    values, order = search.iterate([sim_move_of(root, move) for move in moves], max_depth)
+    return moves[order[0]]
+
+
+BUDGETED_THINKERS = {  # 予算（iterations=反復回数, time_limit=1手あたりの秒数）を指定できる思考ルーチン
+    'montecarlo': think_monte_carlo,
+    'expectimax': think_expectimax,  # iterationsは読む深さ
+}
+SEARCH_EVALUATORS = {  # 手のリストを受け取り、予算を指定してそれぞれの手の評価値（AIから見て -1〜1）を返す探索
+    'montecarlo': monte_carlo_values,
+    'expectimax': expectimax_values,
+}
+
+
 if __name__ == '__main__':
     main()